@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./benchmark_encoder.py startup --model_name 117M
+#  PYTHONPATH=src ./benchmark_encoder.py tokenize /path/to/text.txt --model_name 117M
+
+import codecs
+import fire
+import os
+import regex as re
+import time
+
+import encoder
+
+
+def timeit(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def startup(model_name='117M', repeat=10):
+    """Compare building an Encoder from the text files and from encoder.bin."""
+    model_dir = os.path.join('models', model_name)
+    compiled = os.path.join(model_dir, encoder.COMPILED_ENCODER)
+    if not os.path.exists(compiled):
+        encoder.compile_encoder(model_name)
+
+    def from_text():
+        encoder.Encoder(*encoder.load_text_encoder(model_dir))
+
+    def from_compiled():
+        encoder.Encoder(*encoder.load_compiled_encoder(compiled))
+
+    text_time = timeit(from_text, repeat)
+    compiled_time = timeit(from_compiled, repeat)
+    print('text files:   {:8.1f} ms'.format(text_time * 1000))
+    print('encoder.bin:  {:8.1f} ms ({:.1f}x)'.format(compiled_time * 1000, text_time / compiled_time))
+
+
+def tokenize(path, model_name='117M', max_chars=10**7, repeat=3):
+    """Time the byte to unicode mapping and encode() on the text in path."""
+    with open(path, 'r', encoding='utf8', errors='ignore') as fp:
+        text = fp.read(max_chars)
+    enc = encoder.get_encoder(model_name)
+    tokens = re.findall(enc.pat, text)
+    print('{} characters, {} pre-tokens'.format(len(text), len(tokens)))
+
+    def generator_mapping():
+        for token in tokens:
+            ''.join(enc.byte_encoder[b] for b in token.encode('utf-8'))
+
+    def charmap_mapping():
+        for token in tokens:
+            codecs.charmap_decode(token.encode('utf-8'), 'strict', enc.byte_encoder_table)
+
+    generator_time = timeit(generator_mapping, repeat)
+    charmap_time = timeit(charmap_mapping, repeat)
+    print('byte mapping, generator:  {:8.1f} ms'.format(generator_time * 1000))
+    print('byte mapping, charmap:    {:8.1f} ms ({:.1f}x)'.format(charmap_time * 1000, generator_time / charmap_time))
+
+    def cold():
+        encoder.Encoder(enc.encoder, enc.bpe_merges, cache_size=0).encode(text)
+
+    print('encode, no caches:        {:8.1f} ms'.format(timeit(cold, 1) * 1000))
+    enc.encode(text)
+    print('encode, warm caches:      {:8.1f} ms'.format(timeit(lambda: enc.encode(text), repeat) * 1000))
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./compile_encoder.py 117M
+#
+# Writes models/117M/encoder.bin, which encoder.get_encoder loads in place of
+# encoder.json and vocab.bpe for a faster start.
+
+import fire
+
+import encoder
+
+
+if __name__ == '__main__':
+    fire.Fire(encoder.compile_encoder)
@@ -1,7 +1,21 @@
 #!/usr/bin/env python3
 # Usage:
-#  PYTHONPATH=src ./encode.py <file|directory|glob> /path/to/output.npz
+#  PYTHONPATH=src ./encode.py <file|directory|glob> /path/to/output.npz [--workers N]
 #  PYTHONPATH=src ./train --dataset /path/to/output.npz
+#
+# An output named *.tokens.npy is written as a flat uint16 token store instead,
+# with document offsets in *.offsets.npy, which training memory-maps:
+#  PYTHONPATH=src ./encode.py <file|directory|glob> /path/to/output.tokens.npy
+#  PYTHONPATH=src ./train --dataset /path/to/output.tokens.npy
+#
+# An output ending in / (or an existing directory) is a dataset directory of token
+# store shards with a manifest. Rerunning only encodes new or changed files, and an
+# interrupted run resumes after the last shard it wrote:
+#  PYTHONPATH=src ./encode.py <file|directory|glob> /path/to/dataset/ [--shard_files N]
+#      [--max_shard_tokens N] [--max_shard_bytes N]
+#  PYTHONPATH=src ./train --dataset /path/to/dataset
+# Shards are written as they fill, so memory is bounded by the shard size. Training
+# also takes a glob of dataset directories or of their shard-*.tokens.npy files.
 
 import fire
 import json
@@ -10,41 +24,25 @@ import numpy as np
 import tensorflow as tf
 import random
 import time
-import tqdm
-import glob
 
 import encoder
+from load_dataset import load_dataset, encode_dataset_dir, write_token_store, documents, TOKENS_SUFFIX
 
 
-def load_dataset(enc, path):
-    paths = []
-    if os.path.isfile(path):
-        # Simple file
-        paths.append(path)
-    elif os.path.isdir(path):
-        # Directory
-        for (dirpath, _, fnames) in os.walk(path):
-            for fname in fnames:
-                paths.append(os.path.join(dirpath, fname))
-    else:
-        # Assume glob
-        paths = glob.glob(path)
-
-    token_chunks = []
-    for path in tqdm.tqdm(paths):
-        with open(path, 'r', encoding='utf8', errors='ignore') as fp:
-            raw_text = fp.read()
-        tokens = np.stack(enc.encode(raw_text))
-        token_chunks.append(tokens)
-    return token_chunks
-
-
-def encode_main(in_text, out_npz, model_name='117M'):
+def encode_main(in_text, out_npz, model_name='117M', workers=1, shard_files=1000,
+                max_shard_tokens=None, max_shard_bytes=2**28):
     enc = encoder.get_encoder(model_name)
+    if out_npz.endswith('/') or os.path.isdir(out_npz):
+        encode_dataset_dir(enc, in_text, out_npz, model_name, workers=workers, shard_files=shard_files,
+                           max_shard_tokens=max_shard_tokens, max_shard_bytes=max_shard_bytes)
+        return
     print('Reading files')
-    chunks = load_dataset(enc, in_text)
+    chunks = load_dataset(enc, in_text, workers=workers, skip_errors=True)
     print('Writing', out_npz)
-    np.savez_compressed(out_npz, *chunks)
+    if out_npz.endswith(TOKENS_SUFFIX):
+        write_token_store(out_npz, chunks)
+    else:
+        np.savez_compressed(out_npz, *documents(chunks))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+import tensorflow as tf
+
+
+class AccumulatingOptimizer(object):
+    """Adds up gradients over several micro-batches and applies their mean in one update.
+
+    Wraps any tf.train.Optimizer, including the AdafactorOptimizer of
+    trainval_adafactor.py. For every effective batch, run reset(), then
+    compute_gradients() once per micro-batch, then apply_gradients(), which
+    evaluates to the mean loss of the micro-batches.
+    """
+
+    def __init__(self, opt, var_list):
+        self.opt = opt
+        self.var_list = var_list
+        self.accum_vars = [
+            tf.Variable(tf.zeros(v.shape, dtype=v.dtype.base_dtype), trainable=False)
+            for v in var_list
+        ]
+        self.total_loss = tf.Variable(0.0, trainable=False)
+        self.count_loss = tf.Variable(0.0, trainable=False)
+
+    def reset(self):
+        updates = [v.assign(tf.zeros_like(v)) for v in self.accum_vars]
+        updates.append(self.total_loss.assign(0.0))
+        updates.append(self.count_loss.assign(0.0))
+        return tf.group(*updates)
+
+    def compute_gradients(self, loss, grads=None):
+        """Op adding the gradients of loss to the accumulators.
+
+        grads are the gradients of loss for var_list when they come from
+        elsewhere, such as memory_saving_gradients; by default the wrapped
+        optimizer computes them.
+        """
+        if grads is None:
+            grads = [g for g, _ in self.opt.compute_gradients(loss, self.var_list)]
+        updates = []
+        for a, g in zip(self.accum_vars, grads):
+            if g is None:
+                continue
+            if isinstance(g, tf.IndexedSlices):
+                # Embedding lookups (wpe) only add to the rows they gathered
+                updates.append(tf.scatter_add(a, g.indices, g.values))
+            else:
+                updates.append(a.assign_add(g))
+        updates.append(self.total_loss.assign_add(loss))
+        updates.append(self.count_loss.assign_add(1.0))
+        return tf.group(*updates)
+
+    def apply_gradients(self):
+        grads = [(a / self.count_loss, v) for a, v in zip(self.accum_vars, self.var_list)]
+        with tf.control_dependencies([self.opt.apply_gradients(grads)]):
+            return self.total_loss / self.count_loss
+
+
+# How gradients are computed: 'off' for tf.gradients, otherwise the checkpoints
+# argument of memory_saving_gradients.gradients
+MEMORY_SAVING_GRADIENTS = ('off', 'collection', 'speed', 'memory')
+
+
+def build_train_ops(opt, loss, train_vars, memory_saving_gradients='off', accumulate_gradients=1):
+    """Ops taking one optimizer step on the gradients of loss for train_vars.
+
+    Returns (reset, compute, apply) for run_train_step; apply evaluates to the
+    loss of the step. memory_saving_gradients is one of MEMORY_SAVING_GRADIENTS.
+    With accumulate_gradients > 1 the gradients are added up over that many
+    micro-batches by an AccumulatingOptimizer and applied once, otherwise reset
+    and compute are None and apply does it all.
+    """
+    # Gradients checkpointed by memory_saving_gradients trade recomputation for memory
+    if memory_saving_gradients == 'off':
+        grads = tf.gradients(loss, train_vars)
+    elif memory_saving_gradients in MEMORY_SAVING_GRADIENTS:
+        from memory_saving_gradients import gradients as checkpointed_gradients
+        grads = checkpointed_gradients(loss, train_vars, checkpoints=memory_saving_gradients)
+    else:
+        raise ValueError('memory_saving_gradients must be one of %s, not %r'
+                         % (', '.join(MEMORY_SAVING_GRADIENTS), memory_saving_gradients))
+    if accumulate_gradients > 1:
+        opt = AccumulatingOptimizer(opt=opt, var_list=train_vars)
+        return opt.reset(), opt.compute_gradients(loss, grads=grads), opt.apply_gradients()
+    with tf.control_dependencies([opt.apply_gradients(list(zip(grads, train_vars)))]):
+        return None, None, tf.identity(loss)
+
+
+def run_train_step(sess, train_ops, accumulate_gradients=1, feed=None):
+    """Run the ops of build_train_ops for one optimizer step and return its loss.
+
+    feed, if given, is called for the feed_dict of every micro-batch.
+    """
+    reset, compute, apply = train_ops
+    if accumulate_gradients <= 1:
+        return sess.run(apply, feed_dict=feed and feed())
+    sess.run(reset)
+    for _ in range(accumulate_gradients):
+        sess.run(compute, feed_dict=feed and feed())
+    return sess.run(apply)
@@ -1,10 +1,21 @@
 """Byte pair encoding utilities"""
 
 import os
+import codecs
+import hashlib
 import json
+import struct
+import multiprocessing
+import heapq
+import threading
+import numpy as np
 import regex as re
+from collections import OrderedDict, namedtuple
 from functools import lru_cache
 
+# Number of distinct pre-tokens Encoder keeps token ids for.
+DEFAULT_CACHE_SIZE = 2**18
+
 @lru_cache()
 def bytes_to_unicode():
     """
@@ -39,79 +50,370 @@ def get_pairs(word):
         prev_char = char
     return pairs
 
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+class LRUCache:
+    """Mapping bounded to maxsize entries, evicting the least recently used one.
+
+    Counts hits, misses and evictions so the size can be tuned from real traffic.
+    A maxsize of None never evicts. Safe to share between threads, as an Encoder
+    in a long-running inference server is.
+    """
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        # Another thread may evict the key between the lookup and move_to_end
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if self.maxsize is not None and len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self.data))
+
+class IncrementalDecoder:
+    """Decodes a stream of token ids one id at a time.
+
+    Only complete text is returned; the leading bytes of a UTF-8 character that is
+    split across tokens are held back until the rest arrives. Concatenating every
+    result and a final flush() gives the same text as Encoder.decode on all ids.
+    """
+    def __init__(self, decoder_bytes, errors='replace'):
+        self.decoder_bytes = decoder_bytes
+        self.utf8 = codecs.getincrementaldecoder('utf-8')(errors)
+
+    def decode(self, token):
+        return self.utf8.decode(self.decoder_bytes[token])
+
+    def decode_tokens(self, tokens):
+        return self.utf8.decode(b''.join(map(self.decoder_bytes.__getitem__, tokens)))
+
+    def flush(self):
+        """Return whatever is left at the end of the stream, replacing a truncated character."""
+        return self.utf8.decode(b'', final=True)
+
+    def reset(self):
+        self.utf8.reset()
+
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors='replace'):
+    def __init__(self, encoder, bpe_merges, errors='replace', cache_size=DEFAULT_CACHE_SIZE):
         self.encoder = encoder
         self.decoder = {v:k for k,v in self.encoder.items()}
         self.errors = errors # how to handle errors in decoding
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v:k for k, v in self.byte_encoder.items()}
+        # The byte mapping as a charmap codec, which translates a whole string in one C call
+        self.byte_encoder_table = ''.join(self.byte_encoder[b] for b in range(256))
+        self.byte_decoder_map = codecs.charmap_build(self.byte_encoder_table)
+        # Raw bytes of every token, so decoding is a single join
+        self.decoder_bytes = {
+            v: codecs.charmap_encode(k, 'strict', self.byte_decoder_map)[0] for k, v in self.encoder.items()
+        }
+        self.bpe_merges = bpe_merges
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        # Final ids of each raw pre-token, so a repeated word skips byte mapping and BPE.
+        # This is the only cache; size it from the counts of cache_info().
+        self.cache = LRUCache(cache_size)
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+        # Positions where a pre-token starts no matter what text precedes them
+        self.boundary = re.compile(r'(?<=\S)\s')
+        self._fingerprint = None
 
-    def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
+    def fingerprint(self):
+        """Hex digest of the vocabulary and merges, for keying encodings cached on disk."""
+        if self._fingerprint is None:
+            tokens = sorted(self.encoder.items(), key=lambda item: item[1])
+            data = json.dumps([tokens, self.bpe_merges], ensure_ascii=False)
+            self._fingerprint = hashlib.sha1(data.encode('utf-8')).hexdigest()
+        return self._fingerprint
+
+    def cache_info(self):
+        """Hit, miss and eviction counts of the pre-token to ids cache."""
+        return self.cache.info()
 
-        if not pairs:
+    def bpe(self, token):
+        if len(token) < 2:
             return token
 
-        while True:
-            bigram = min(pairs, key = lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
+        # Symbols live in a doubly linked list over their original positions, and
+        # every adjacent pair with a rank sits in a heap keyed by (rank, position).
+        # Popping the heap yields the same merge order as repeatedly taking the
+        # lowest ranked pair and merging its occurrences left to right, without
+        # rescanning or rebuilding the word after each merge.
+        ranks = self.bpe_ranks
+        symbols = list(token)
+        n = len(symbols)
+        left = list(range(-1, n - 1))
+        right = list(range(1, n + 1))
+        heap = []
+        for i in range(n - 1):
+            rank = ranks.get((symbols[i], symbols[i+1]))
+            if rank is not None:
+                heap.append((rank, i))
+        heapq.heapify(heap)
 
-                if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                    new_word.append(first+second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
-        self.cache[token] = word
-        return word
+        while heap:
+            rank = heap[0][0]
+            # Pairs created while merging this rank are only queued once every
+            # occurrence of it has been merged, matching a single left to right
+            # merge pass over the word.
+            created = []
+            while heap and heap[0][0] == rank:
+                _, i = heapq.heappop(heap)
+                j = right[i]
+                # Skip stale entries whose symbols have since been merged away.
+                if symbols[i] is None or j >= n or ranks.get((symbols[i], symbols[j])) != rank:
+                    continue
+                symbols[i] += symbols[j]
+                symbols[j] = None
+                right[i] = right[j]
+                if right[i] < n:
+                    left[right[i]] = i
+                if left[i] >= 0:
+                    created.append(left[i])
+                if right[i] < n:
+                    created.append(i)
+            for i in created:
+                if symbols[i] is None:
+                    continue
+                j = right[i]
+                pair_rank = ranks.get((symbols[i], symbols[j]))
+                if pair_rank is not None:
+                    heapq.heappush(heap, (pair_rank, i))
+
+        return ' '.join(s for s in symbols if s is not None)
+
+    def _token_ids(self, token):
+        """Return the ids of a single pre-token matched by self.pat."""
+        ids = self.cache.get(token)
+        if ids is None:
+            word = codecs.charmap_decode(token.encode('utf-8'), 'strict', self.byte_encoder_table)[0]
+            ids = tuple(self.encoder[bpe_token] for bpe_token in self.bpe(word).split(' '))
+            self.cache[token] = ids
+        return ids
 
     def encode(self, text):
         bpe_tokens = []
         for token in re.findall(self.pat, text):
-            token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
-            bpe_tokens.extend(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
+            bpe_tokens.extend(self._token_ids(token))
         return bpe_tokens
 
+    def count_tokens(self, text, limit=None):
+        """Return len(self.encode(text)), without building the list of ids.
+
+        With a limit the count stops as soon as it exceeds limit, so any result
+        greater than limit only means that the text does not fit.
+        """
+        count = 0
+        for match in self.pat.finditer(text):
+            count += len(self._token_ids(match.group()))
+            if limit is not None and count > limit:
+                break
+        return count
+
+    def encode_tail(self, text, max_tokens):
+        """Return self.encode(text)[-max_tokens:], pre-tokenizing only as much of the end of text as it needs.
+
+        Whitespace that follows a non-whitespace character always starts a new
+        pre-token, whatever comes before it, so encoding from such a position gives
+        the same ids as the end of encoding the whole text. Suffixes of doubling
+        length are tried until one holds max_tokens ids from such a position on.
+        """
+        if max_tokens <= 0:
+            return []
+        span = 4 * max_tokens + 16
+        while span < len(text):
+            boundary = self.boundary.search(text, len(text) - span)
+            if boundary is not None:
+                bpe_tokens = []
+                for match in self.pat.finditer(text, boundary.start()):
+                    bpe_tokens.extend(self._token_ids(match.group()))
+                if len(bpe_tokens) >= max_tokens:
+                    return bpe_tokens[-max_tokens:]
+            span *= 2
+        return self.encode(text)[-max_tokens:]
+
+    def encode_stream(self, fp, chunk_size=2**20):
+        """Yield the token ids of a text file object, reading chunk_size characters at a time.
+
+        A pre-token of the text read so far is final once it ends at least three
+        characters before the end: the contractions ('ll, 're, 've) are the longest
+        alternatives of the regex, and no alternative looks further ahead. Pre-tokens
+        closer to the end can still change as more text arrives, so they are carried
+        over into the next chunk. That keeps the output identical to
+        encode(fp.read()) while memory stays bounded by chunk_size.
+        """
+        pending = ''
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            text = pending + chunk
+            final = len(text) - 3
+            start = len(text)
+            for match in self.pat.finditer(text):
+                if match.end() > final:
+                    start = match.start()
+                    break
+                yield from self._token_ids(match.group())
+            pending = text[start:]
+        yield from self.encode(pending)
+
+    def pool(self, workers=None):
+        """Return a process pool whose workers each build a copy of this encoder once.
+
+        Tasks run in the pool can reach that copy through worker_encoder(), so the
+        vocabulary and merge tables are not pickled along with every task.
+        """
+        return multiprocessing.Pool(
+            workers,
+            initializer=_init_worker,
+            initargs=(self.encoder, self.bpe_merges, self.errors, self.cache.maxsize),
+        )
+
+    def encode_batch(self, texts, workers=None, chunksize=None, pool=None):
+        """Encode a list of texts on a pool of worker processes.
+
+        The result is in input order. workers defaults to the number of CPUs; with a
+        single worker or text everything is encoded in this process.
+
+        Without pool, every call starts a pool of its own, which sends the tables to
+        and builds an Encoder in each worker before any text is encoded. Callers that
+        encode batch after batch should pass a pool from self.pool() instead, which
+        is reused as is and left open.
+        """
+        texts = list(texts)
+        if pool is not None:
+            return pool.map(_encode_in_worker, texts, chunksize)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(texts))
+        if workers <= 1:
+            return [self.encode(text) for text in texts]
+        with self.pool(workers) as pool:
+            return pool.map(_encode_in_worker, texts, chunksize)
+
     def decode(self, tokens):
-        text = ''.join([self.decoder[token] for token in tokens])
-        text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors=self.errors)
+        if isinstance(tokens, np.ndarray):
+            tokens = tokens.tolist()
+        text = b''.join(map(self.decoder_bytes.__getitem__, tokens)).decode('utf-8', errors=self.errors)
         return text
 
-def get_encoder(model_name):
-    with open(os.path.join('models', model_name, 'encoder.json'), 'r') as f:
+    def incremental_decoder(self):
+        """Return an IncrementalDecoder for streaming generated tokens to a client."""
+        return IncrementalDecoder(self.decoder_bytes, errors=self.errors)
+
+    def decode_batch(self, tokens):
+        """Decode every row of a 2-D array of ids, such as the output of sample_sequence."""
+        return [self.decode(row) for row in np.asarray(tokens).tolist()]
+
+_worker = None
+
+def _init_worker(encoder, bpe_merges, errors, cache_size):
+    global _worker
+    _worker = Encoder(encoder, bpe_merges, errors=errors, cache_size=cache_size)
+
+def worker_encoder():
+    """The encoder of the current Encoder.pool() worker process."""
+    return _worker
+
+def _encode_in_worker(text):
+    return _worker.encode(text)
+
+# Layout of the compiled encoder written by compile_encoder: a header, the ids of
+# the left and right symbol of every merge in rank order, then every token in id
+# order as newline separated UTF-8, which never occurs inside a byte-mapped token.
+COMPILED_ENCODER = 'encoder.bin'
+COMPILED_MAGIC = b'GPT2BPE1'
+COMPILED_HEADER = struct.Struct('<8sIII')
+
+def load_text_encoder(model_dir):
+    """Read the vocabulary and merges from encoder.json and vocab.bpe."""
+    with open(os.path.join(model_dir, 'encoder.json'), 'r') as f:
         encoder = json.load(f)
-    with open(os.path.join('models', model_name, 'vocab.bpe'), 'r', encoding="utf-8") as f:
+    with open(os.path.join(model_dir, 'vocab.bpe'), 'r', encoding="utf-8") as f:
         bpe_data = f.read()
     bpe_merges = [tuple(merge_str.split()) for merge_str in bpe_data.split('\n')[1:-1]]
+    return encoder, bpe_merges
+
+def load_compiled_encoder(path):
+    """Read the vocabulary and merges from a file written by compile_encoder."""
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    magic, n_tokens, n_merges, vocab_bytes = COMPILED_HEADER.unpack_from(data)
+    if magic != COMPILED_MAGIC:
+        raise ValueError('%s is not a compiled encoder' % path)
+    offset = COMPILED_HEADER.size
+    merges = np.frombuffer(data, dtype='<u4', count=2 * n_merges, offset=offset).tolist()
+    offset += 8 * n_merges
+    tokens = data[offset:offset + vocab_bytes].tobytes().decode('utf-8').split('\n')
+    assert len(tokens) == n_tokens, 'Corrupt compiled encoder %s' % path
+    encoder = dict(zip(tokens, range(n_tokens)))
+    bpe_merges = list(zip([tokens[i] for i in merges[0::2]], [tokens[i] for i in merges[1::2]]))
+    return encoder, bpe_merges
+
+def compile_encoder(model_name):
+    """Write models/<model_name>/encoder.bin, which get_encoder loads in place of the text files."""
+    model_dir = os.path.join('models', model_name)
+    encoder, bpe_merges = load_text_encoder(model_dir)
+    tokens = sorted(encoder, key=encoder.get)
+    if [encoder[token] for token in tokens] != list(range(len(tokens))):
+        raise ValueError('Token ids of %s are not contiguous from 0' % model_name)
+    if any('\n' in token for token in tokens):
+        raise ValueError('Vocabulary of %s contains a newline' % model_name)
+    merges = np.array([[encoder[first], encoder[second]] for first, second in bpe_merges], dtype='<u4')
+    vocab = '\n'.join(tokens).encode('utf-8')
+
+    path = os.path.join(model_dir, COMPILED_ENCODER)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(COMPILED_HEADER.pack(COMPILED_MAGIC, len(tokens), len(bpe_merges), len(vocab)))
+        f.write(merges.tobytes())
+        f.write(vocab)
+    os.replace(path + '.tmp', path)
+    print('Wrote', path)
+
+def get_encoder(model_name, cache_size=DEFAULT_CACHE_SIZE):
+    model_dir = os.path.join('models', model_name)
+    compiled = os.path.join(model_dir, COMPILED_ENCODER)
+    sources = [os.path.join(model_dir, name) for name in ('encoder.json', 'vocab.bpe')]
+    # Only trust the compiled encoder if it is newer than the text files it came from.
+    if os.path.exists(compiled) and all(
+            not os.path.exists(source) or os.path.getmtime(source) <= os.path.getmtime(compiled)
+            for source in sources):
+        encoder, bpe_merges = load_compiled_encoder(compiled)
+    else:
+        encoder, bpe_merges = load_text_encoder(model_dir)
     return Encoder(
         encoder=encoder,
         bpe_merges=bpe_merges,
+        cache_size=cache_size,
     )
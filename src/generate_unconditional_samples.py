@@ -64,9 +64,8 @@ def sample_model(
         generated = 0
         while nsamples == 0 or generated < nsamples:
             out = sess.run(output)
-            for i in range(batch_size):
+            for text in enc.decode_batch(out):
                 generated += batch_size
-                text = enc.decode(out[i])
                 print("=" * 40 + " SAMPLE " + str(generated) + " " + "=" * 40)
                 print(text)
 
@@ -70,15 +70,20 @@ def interact_model(
             while not raw_text:
                 print('Prompt should not be empty!')
                 raw_text = '\n'.join(iter(input, 'EOF'))
-            context_tokens = enc.encode(raw_text)
+            # Keep only as much of the prompt as fits in the window next to the sample
+            max_context = hparams.n_ctx - length
+            if enc.count_tokens(raw_text, limit=max_context) > max_context:
+                print('Prompt is too long, keeping its last', max_context, 'tokens')
+                context_tokens = enc.encode_tail(raw_text, max_context)
+            else:
+                context_tokens = enc.encode(raw_text)
             generated = 0
             for _ in range(nsamples // batch_size):
                 out = sess.run(output, feed_dict={
                     context: [context_tokens for _ in range(batch_size)]
                 })[:, len(context_tokens):]
-                for i in range(batch_size):
+                for text in enc.decode_batch(out):
                     generated += 1
-                    text = enc.decode(out[i])
                     print("=" * 40 + " SAMPLE " + str(generated) + " " + "=" * 40)
                     print(text)
             print("=" * 80)
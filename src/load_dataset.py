@@ -0,0 +1,789 @@
+import functools
+import glob
+import hashlib
+import json
+import numpy as np
+import os
+import queue
+import threading
+import time
+import zipfile
+
+import encoder
+
+# A token store is every document's tokens back to back in one flat uint16 array,
+# saved as <name>.tokens.npy, plus the start of each document and the total
+# length in <name>.offsets.npy. The token file is memory-mapped when loaded.
+TOKENS_SUFFIX = '.tokens.npy'
+OFFSETS_SUFFIX = '.offsets.npy'
+
+# A dataset directory holds token store shards plus a manifest recording, for
+# every source file, its size, mtime and content hash and where its documents
+# live. Only documents listed in the manifest are part of the dataset; those of
+# files that have since changed stay in their old shard but are no longer used.
+# The name is one no text corpus is likely to contain.
+MANIFEST = '.gpt2_dataset.json'
+MANIFEST_KEYS = ('model_name', 'shards', 'files')
+
+# Raw text and npz inputs are converted once into a token store kept in this
+# directory next to them, keyed by the encoder and the content hash of the input.
+# The size, mtime and hash of each input are recorded there too, so an input is
+# only hashed again once its size or mtime changes.
+CACHE_DIR = '.token_cache'
+
+
+def offsets_path(tokens_path):
+    return tokens_path[:-len(TOKENS_SUFFIX)] + OFFSETS_SUFFIX
+
+
+class TokenStore(object):
+    """The documents of a token store, kept as its flat token array and their offsets in it.
+
+    One TokenStore stands for all of its documents in a list of chunks, so loading
+    a store takes the same time however many documents it holds. Indexing returns
+    a document, sliced out of the tokens only then, and slicing returns a
+    TokenStore of a range of documents sharing the same tokens.
+    """
+
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            assert step == 1, 'Token stores are sliced in steps of one document'
+            return TokenStore(self.tokens, self.offsets[start:max(start, stop) + 1])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Document {} of {}'.format(index, len(self)))
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets, offsets[1:]):
+            yield self.tokens[start:end]
+
+    def flat(self):
+        """All the tokens of the documents, back to back."""
+        return self.tokens[self.offsets[0]:self.offsets[-1]]
+
+
+def documents(chunks):
+    """Iterate over the documents of chunks, those of a TokenStore one by one."""
+    for chunk in chunks:
+        if isinstance(chunk, TokenStore):
+            yield from chunk
+        else:
+            yield chunk
+
+
+def document_index(chunks):
+    """Locate the documents of chunks without slicing any out of a TokenStore.
+
+    Returns (segments, segment, start, size): the token arrays the documents lie
+    in, and for every document the number of its segment, the position it starts
+    at in the segment and its number of tokens.
+    """
+    segments = []
+    segment, start, size = [], [], []
+    # Documents of plain arrays, gathered until the next TokenStore
+    plain = ([], [])
+
+    def add_plain():
+        if plain[0]:
+            segment.append(np.array(plain[0], dtype=np.int64))
+            start.append(np.zeros(len(plain[0]), dtype=np.int64))
+            size.append(np.array(plain[1], dtype=np.int64))
+            del plain[0][:], plain[1][:]
+
+    for chunk in chunks:
+        if isinstance(chunk, TokenStore):
+            add_plain()
+            offsets = np.asarray(chunk.offsets, dtype=np.int64)
+            segment.append(np.full(len(chunk), len(segments), dtype=np.int64))
+            start.append(offsets[:-1])
+            size.append(np.diff(offsets))
+            segments.append(chunk.tokens)
+        else:
+            plain[0].append(len(segments))
+            plain[1].append(chunk.shape[0])
+            segments.append(chunk)
+    add_plain()
+    if not segment:
+        return segments, np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64)
+    return segments, np.concatenate(segment), np.concatenate(start), np.concatenate(size)
+
+
+def document_sizes(chunks):
+    """The number of tokens of every document of chunks, as an array."""
+    return document_index(chunks)[3]
+
+
+def write_token_store(path, chunks):
+    """Write chunks to a token store whose token file is path."""
+    assert path.endswith(TOKENS_SUFFIX), 'Token stores are named *' + TOKENS_SUFFIX
+    sizes = document_sizes(chunks)
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    tokens = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint16, shape=(int(offsets[-1]),))
+    end = 0
+    for chunk in chunks:
+        # The documents of a TokenStore are copied in one go
+        if isinstance(chunk, TokenStore):
+            chunk = chunk.flat()
+        start, end = end, end + chunk.shape[0]
+        if len(chunk) and chunk.max() > np.iinfo(np.uint16).max:
+            raise ValueError('Token ids do not fit in uint16')
+        tokens[start:end] = chunk
+    tokens.flush()
+    del tokens
+    np.save(offsets_path(path), offsets)
+
+
+def load_token_store(path):
+    """Return the TokenStore at path, its tokens memory-mapped."""
+    return TokenStore(np.load(path, mmap_mode='r'), np.load(offsets_path(path)))
+
+
+def write_cache_record(path, record):
+    """Write the size, mtime and hash of a cached input, if the cache directory is writable."""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(record, fp)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print('Could not record', path, e)
+
+
+def load_cached_file(enc, path):
+    """Load a text or npz file through its cached token store, writing the store on first use."""
+    dirname, basename = os.path.split(path)
+    prefix = '{}.{}.'.format(basename, enc.fingerprint()[:16])
+    stat = os.stat(path)
+    record_path = os.path.join(dirname, CACHE_DIR, prefix + 'json')
+    try:
+        with open(record_path, 'r') as fp:
+            record = json.load(fp)
+    except (OSError, ValueError):
+        record = {}
+    if (record.get('size'), record.get('mtime')) != (stat.st_size, stat.st_mtime):
+        record = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': file_digest(path)}
+        write_cache_record(record_path, record)
+    key = prefix + record['sha1'][:16]
+    cached = os.path.join(dirname, CACHE_DIR, key + TOKENS_SUFFIX)
+    if os.path.exists(cached):
+        return [load_token_store(cached)]
+
+    chunks = load_file(enc, path)
+    try:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        # Write under a temporary name so a partial store is never picked up
+        tmp = os.path.join(dirname, CACHE_DIR, 'tmp{}-{}{}'.format(os.getpid(), key, TOKENS_SUFFIX))
+        write_token_store(tmp, chunks)
+        os.replace(offsets_path(tmp), offsets_path(cached))
+        os.replace(tmp, cached)
+    except OSError as e:
+        print('Could not cache tokens of', path, e)
+        return chunks
+    # Drop stores cached for earlier contents of the same file. Another process
+    # loading the same file may be removing them too, which is no reason to fail.
+    for stale in glob.glob(os.path.join(dirname, CACHE_DIR, glob.escape(prefix) + '*' + TOKENS_SUFFIX)):
+        if stale == cached:
+            continue
+        for stale_path in (offsets_path(stale), stale):
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print('Could not remove stale cache', stale_path, e)
+    return [load_token_store(cached)]
+
+
+def load_file(enc, path, cache=False):
+    """Return the token chunks stored in, or encoded from, a single file.
+
+    With cache, text and npz files are loaded through a token store cached next
+    to them, so they are encoded or decompressed only once and then memory-mapped.
+    """
+    if cache and not os.path.isdir(path) and not path.endswith(TOKENS_SUFFIX):
+        return load_cached_file(enc, path)
+    if path.endswith('.npz'):
+        # Pre-encoded
+        with np.load(path) as npz:
+            return [npz[item] for item in npz.files]
+    if os.path.isdir(path):
+        return load_dataset_dir(path)
+    if path.endswith(TOKENS_SUFFIX):
+        out_dir, name = os.path.split(path)
+        if is_dataset_dir(out_dir):
+            # A shard of a dataset directory, which may hold superseded documents
+            return load_dataset_dir(out_dir, shards=[name[:-len(TOKENS_SUFFIX)]])
+        return [load_token_store(path)]
+    # Plain text, encoded as it is read so that memory is bounded by the
+    # encoder's chunk size rather than the size of the file.
+    with open(path, 'r', encoding='utf8', errors='ignore') as fp:
+        return [np.fromiter(enc.encode_stream(fp), dtype=np.int32)]
+
+
+# What a missing, unreadable or corrupt input raises while it is loaded
+LOAD_ERRORS = (OSError, ValueError, EOFError, zipfile.BadZipFile)
+
+
+def try_load_file(enc, path, cache=False):
+    """Return (chunks, None) for a file that loads, or (None, error message) for one that fails."""
+    try:
+        return load_file(enc, path, cache=cache), None
+    except LOAD_ERRORS as e:
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+
+def _load_file_in_worker(path, cache=False):
+    return load_file(encoder.worker_encoder(), path, cache=cache)
+
+
+def _try_load_file_in_worker(path, cache=False):
+    return try_load_file(encoder.worker_encoder(), path, cache=cache)
+
+
+def is_input_file(path):
+    """Whether path is a file to load rather than a part of some other input."""
+    dirname, fname = os.path.split(path)
+    # Offsets are loaded along with their token file, manifests with their
+    # dataset directory, and cached encodings through the files they were made from
+    return (not fname.endswith(OFFSETS_SUFFIX) and fname != MANIFEST
+            and CACHE_DIR not in dirname.split(os.sep))
+
+
+def is_dataset_dir(path):
+    """Whether path is a directory holding a dataset directory manifest."""
+    try:
+        with open(os.path.join(path, MANIFEST), 'r') as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError):
+        return False
+    return isinstance(manifest, dict) and all(key in manifest for key in MANIFEST_KEYS)
+
+
+def list_paths(path):
+    paths = []
+    if os.path.isfile(path):
+        # Simple file
+        paths.append(path)
+    elif os.path.isdir(path) and is_dataset_dir(path):
+        # Dataset directory, loaded as a whole
+        paths.append(path)
+    elif os.path.isdir(path):
+        # Directory
+        for (dirpath, dirnames, fnames) in os.walk(path):
+            if dirpath != path and MANIFEST in fnames and is_dataset_dir(dirpath):
+                # Nested dataset directory, loaded as a whole
+                paths.append(dirpath)
+                dirnames[:] = []
+                continue
+            if CACHE_DIR in dirnames:
+                dirnames.remove(CACHE_DIR)
+            # Walk in a fixed order, so the same tree always gives the same chunks
+            dirnames.sort()
+            for fname in sorted(fnames):
+                if is_input_file(os.path.join(dirpath, fname)):
+                    paths.append(os.path.join(dirpath, fname))
+    else:
+        # Assume glob, which may also match dataset directories or their shards
+        for match in sorted(glob.glob(path)):
+            if os.path.isdir(match) or is_input_file(match):
+                paths.extend(list_paths(match))
+    return paths
+
+
+def iter_load_files(enc, paths, workers=1, cache=False, skip_errors=False):
+    """Yield (path, chunks) for every path, in order.
+
+    A file that fails to load raises, unless skip_errors is set; then it is reported
+    and skipped, which suits encoding a corpus better than training on part of one.
+    """
+    # Imported here so the trainers, which only import this module, do not need tqdm
+    import tqdm
+
+    if workers > 1:
+        pool = enc.pool(workers)
+        load = _try_load_file_in_worker if skip_errors else _load_file_in_worker
+        # Files are encoded in parallel, but imap hands the results back in input order
+        results = pool.imap(functools.partial(load, cache=cache), paths)
+    else:
+        pool = None
+        load = try_load_file if skip_errors else load_file
+        results = (load(enc, path, cache=cache) for path in paths)
+
+    failures = 0
+    try:
+        for path, result in tqdm.tqdm(zip(paths, results), total=len(paths)):
+            if not skip_errors:
+                yield path, result
+                continue
+            chunks, error = result
+            if error is None:
+                yield path, chunks
+            else:
+                tqdm.tqdm.write('Failed to load {}: {}'.format(path, error))
+                failures += 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if failures:
+        print('Skipped', failures, 'of', len(paths), 'files that failed to load')
+
+
+def file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(2**20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST), 'r') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {'model_name': None, 'shards': [], 'files': {}}
+
+
+def write_manifest(out_dir, manifest):
+    path = os.path.join(out_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def load_dataset_dir(out_dir, shards=None):
+    """Return the documents of every file listed in the manifest of a dataset directory.
+
+    If shards is given, only those stored in one of the named shards are returned.
+    """
+    manifest = read_manifest(out_dir)
+    stores = {}
+    token_chunks = []
+    # In source order, so the result does not depend on which run encoded what
+    for source in sorted(manifest['files']):
+        entry = manifest['files'][source]
+        if shards is not None and entry['shard'] not in shards:
+            continue
+        if entry['shard'] not in stores:
+            stores[entry['shard']] = load_token_store(os.path.join(out_dir, entry['shard'] + TOKENS_SUFFIX))
+        token_chunks.append(stores[entry['shard']][entry['first']:entry['first'] + entry['count']])
+    return token_chunks
+
+
+def encode_dataset_dir(enc, path, out_dir, model_name, workers=1, shard_files=1000,
+                       max_shard_tokens=None, max_shard_bytes=2**28):
+    """Encode the new or changed files under path into more shards of the dataset directory out_dir.
+
+    A file is unchanged if its size and mtime match the manifest, or failing that its
+    content hash does. A shard is written out as soon as it holds shard_files files or
+    the next file would take it past max_shard_tokens tokens or max_shard_bytes bytes on
+    disk, so only one shard is ever in memory. A file bigger than the limits gets a shard
+    of its own. The manifest is rewritten after each shard is on disk, so an interrupted
+    run resumes after the last shard it completed.
+
+    out_dir itself is never a source, even when it lies under path. Any other dataset
+    directory under path raises ValueError: its documents are already encoded, so
+    load it alongside out_dir instead.
+    """
+    out_abs = os.path.abspath(out_dir)
+    sources = []
+    for source in sorted(os.path.abspath(p) for p in list_paths(path)):
+        if source == out_abs or source.startswith(out_abs + os.sep):
+            continue
+        if os.path.isdir(source):
+            raise ValueError('{} is a dataset directory, not a source to encode into {}'.format(source, out_dir))
+        sources.append(source)
+
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = read_manifest(out_dir)
+    if manifest['model_name'] not in (None, model_name):
+        raise ValueError('{} was encoded for {}, not {}'.format(out_dir, manifest['model_name'], model_name))
+    manifest['model_name'] = model_name
+    files = manifest['files']
+
+    # Drop the documents of sources that no longer exist
+    for source in [source for source in files if not os.path.exists(source)]:
+        del files[source]
+
+    todo = {}
+    unchanged = 0
+    for source in sources:
+        stat = os.stat(source)
+        entry = files.get(source)
+        if entry is not None and (entry['size'], entry['mtime']) == (stat.st_size, stat.st_mtime):
+            unchanged += 1
+            continue
+        digest = file_digest(source)
+        if entry is not None and entry['sha1'] == digest:
+            entry['size'], entry['mtime'] = stat.st_size, stat.st_mtime
+            unchanged += 1
+            continue
+        todo[source] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': digest}
+    print(len(todo), 'new or changed files,', unchanged, 'unchanged')
+
+    shard_chunks = []
+    shard_entries = {}
+    shard_tokens = 0
+    shard_documents = 0
+
+    def shard_bytes(tokens, documents):
+        # uint16 tokens plus an int64 offset per document and one for the end
+        return 2 * tokens + 8 * (documents + 1)
+
+    def flush():
+        shard = 'shard-{:05d}'.format(len(manifest['shards']))
+        print('Writing', os.path.join(out_dir, shard + TOKENS_SUFFIX))
+        write_token_store(os.path.join(out_dir, shard + TOKENS_SUFFIX), shard_chunks)
+        for entry in shard_entries.values():
+            entry['shard'] = shard
+        files.update(shard_entries)
+        manifest['shards'].append(shard)
+        write_manifest(out_dir, manifest)
+        del shard_chunks[:]
+        shard_entries.clear()
+
+    for source, chunks in iter_load_files(enc, list(todo), workers=workers, skip_errors=True):
+        sizes = document_sizes(chunks)
+        tokens = int(sizes.sum())
+        if shard_entries and (
+                (max_shard_tokens is not None and shard_tokens + tokens > max_shard_tokens) or
+                (max_shard_bytes is not None and
+                 shard_bytes(shard_tokens + tokens, shard_documents + len(sizes)) > max_shard_bytes)):
+            flush()
+            shard_tokens = shard_documents = 0
+        shard_entries[source] = dict(todo[source], first=shard_documents, count=len(sizes))
+        shard_chunks.extend(chunks)
+        shard_tokens += tokens
+        shard_documents += len(sizes)
+        if len(shard_entries) >= shard_files:
+            flush()
+            shard_tokens = shard_documents = 0
+    if shard_entries:
+        flush()
+    # Record hash-only updates even when nothing needed encoding
+    write_manifest(out_dir, manifest)
+
+
+def load_dataset(enc, path, workers=1, cache=False, skip_errors=False):
+    token_chunks = []
+    for _, chunks in iter_load_files(enc, list_paths(path), workers=workers, cache=cache,
+                                     skip_errors=skip_errors):
+        token_chunks.extend(chunks)
+    return token_chunks
+
+
+def pack_chunks(chunks, separator, min_size):
+    """Join consecutive chunks into chunks of at least min_size tokens.
+
+    Documents are separated by the separator token (<|endoftext|>), so corpora of
+    short documents give windows the Sampler can draw from. A chunk that is already
+    long enough and has nothing waiting to be joined is kept as is, memory mapping
+    included; only the last packed chunk can be shorter than min_size, when there
+    is nothing to join it to.
+    """
+    separator = np.array([separator], dtype=np.uint16)
+    packed = []
+    pending = []
+    pending_size = 0
+    for chunk in documents(chunks):
+        if not pending and chunk.shape[0] >= min_size:
+            packed.append(chunk)
+            continue
+        if pending:
+            pending.append(separator)
+            pending_size += 1
+        pending.append(chunk)
+        pending_size += chunk.shape[0]
+        if pending_size >= min_size:
+            packed.append(np.concatenate(pending))
+            pending = []
+            pending_size = 0
+    if pending:
+        if packed:
+            pending = [packed.pop(), separator] + pending
+        packed.append(np.concatenate(pending))
+    return packed
+
+
+def packing_efficiency(chunks, length, real_tokens=None):
+    """Real tokens divided by the tokens of the length-token windows it takes to cover
+    every chunk, padding out the last window of each one."""
+    sizes = document_sizes(chunks)
+    padded = int(np.sum(-(-sizes // length))) * length
+    if real_tokens is None:
+        real_tokens = int(sizes.sum())
+    return real_tokens / padded if padded else 0.0
+
+
+def pack_dataset(chunks, separator, min_size, length):
+    """pack_chunks, printing the packing efficiency for windows of length tokens before and after."""
+    sizes = document_sizes(chunks)
+    before = packing_efficiency(chunks, length)
+    packed = pack_chunks(chunks, separator, min_size)
+    after = packing_efficiency(packed, length, real_tokens=int(sizes.sum()))
+    print('Packed {} documents into {} chunks of at least {} tokens'.format(
+        len(sizes), len(packed), min_size))
+    print('packing efficiency (real / padded tokens in {}-token windows): {:.1%} packed, {:.1%} unpacked'.format(
+        length, after, before))
+    return packed
+
+
+class Sampler(object):
+    """Fairly samples a slice from a set of variable sized chunks.
+
+    'Fairly' means that the distribution is the same as sampling from one concatenated chunk,
+    but without crossing chunk boundaries."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        # Windows are sliced out of the segment holding their document as they are drawn
+        self.segments, self.segment, self.start, self.sizes = document_index(chunks)
+        self.total_size = int(self.sizes.sum())
+        self.starts = {}
+
+    def window_starts(self, length):
+        """Cumulative count, chunk by chunk, of the windows of length tokens that fit inside one chunk.
+
+        Drawing uniformly below the total and locating the draw in this array picks every
+        such window with equal probability, so no draw is ever rejected.
+        """
+        if length not in self.starts:
+            starts = np.zeros(len(self.sizes) + 1, dtype=np.int64)
+            np.cumsum(np.maximum(self.sizes - length + 1, 0), out=starts[1:])
+            self.starts[length] = starts
+        return self.starts[length]
+
+    def windows(self, length):
+        """Number of distinct windows of length tokens there are to sample."""
+        return int(self.window_starts(length)[-1])
+
+    def locate(self, index, length):
+        """Map window numbers below windows(length) to (document, offset within document) arrays."""
+        starts = self.window_starts(length)
+        i = np.searchsorted(starts, index, side='right') - 1
+        return i, index - starts[i]
+
+    def sample(self, length):
+        return self.sample_batch(1, length)[0]
+
+    def sample_batch(self, batch_size, length, rng=None):
+        """Return batch_size windows as one [batch_size, length] int32 array.
+
+        Windows are drawn from rng, a np.random.RandomState, or from the global
+        NumPy random state by default.
+        """
+        rng = np.random if rng is None else rng
+        windows = self.windows(length)
+        assert windows > 0, "Dataset files are too small to sample {} tokens at a time".format(length)
+        document, offset = self.locate(rng.randint(0, windows, size=batch_size), length)
+        segment = self.segment[document]
+        start = self.start[document] + offset
+        batch = np.empty((batch_size, length), dtype=np.int32)
+        for row in range(batch_size):
+            batch[row] = self.segments[segment[row]][start[row]:start[row] + length]
+        return batch
+
+
+class MixtureSampler(object):
+    """Samples from several Samplers, choosing the sampler of each window by weight
+    rather than by the size of its dataset."""
+
+    def __init__(self, samplers, weights):
+        self.samplers = samplers
+        weights = np.array(weights, dtype=np.float64)
+        assert len(weights) == len(samplers) and (weights >= 0).all() and weights.sum() > 0, \
+            "Need one non-negative weight per dataset, and a positive total"
+        self.weights = weights / weights.sum()
+        self.total_size = sum(sampler.total_size for sampler in samplers)
+
+    def windows(self, length):
+        return sum(sampler.windows(length) for sampler in self.samplers)
+
+    def sample(self, length):
+        return self.sample_batch(1, length)[0]
+
+    def sample_batch(self, batch_size, length, rng=None):
+        """Return batch_size windows as one [batch_size, length] int32 array, drawn as by Sampler.sample_batch."""
+        rng = np.random if rng is None else rng
+        source = rng.choice(len(self.samplers), size=batch_size, p=self.weights)
+        batch = np.empty((batch_size, length), dtype=np.int32)
+        for i, sampler in enumerate(self.samplers):
+            rows = np.flatnonzero(source == i)
+            if len(rows):
+                batch[rows] = sampler.sample_batch(len(rows), length, rng=rng)
+        return batch
+
+
+def parse_mixture(spec):
+    """Split a dataset spec such as 'a:0.7,b:0.3' into [('a', 0.7), ('b', 0.3)].
+
+    A dataset without a weight gets 1. fire hands over 'a,b' as a tuple, which is
+    accepted as well.
+    """
+    parts = [str(part) for part in spec] if isinstance(spec, (list, tuple)) else spec.split(',')
+    sources = []
+    for part in parts:
+        path, sep, weight = part.rpartition(':')
+        try:
+            sources.append((path, float(weight)) if sep else (part, 1.0))
+        except ValueError:
+            sources.append((part, 1.0))
+    return sources
+
+
+def load_sampler(enc, spec, combine=None, length=1024, cache=False):
+    """Load the datasets of a spec as parsed by parse_mixture and return a sampler over them.
+
+    Each dataset gets a Sampler of its own, so memory-mapped token stores stay
+    mapped; several datasets are drawn from by weight through a MixtureSampler.
+    With combine, short documents are packed as by pack_dataset.
+    """
+    sources = parse_mixture(spec)
+    samplers = []
+    for path, weight in sources:
+        chunks = load_dataset(enc, path, cache=cache)
+        if combine:
+            chunks = pack_dataset(chunks, enc.encoder['<|endoftext|>'], combine, length)
+        samplers.append(Sampler(chunks))
+        if len(sources) > 1:
+            print(path, 'has', samplers[-1].total_size, 'tokens, weight', weight)
+    if len(samplers) == 1:
+        return samplers[0]
+    return MixtureSampler(samplers, [weight for _, weight in sources])
+
+
+def validation_windows(sampler, count, length, seed=0):
+    """Draw count windows of length tokens from sampler, the same ones for the same seed.
+
+    The global NumPy random state is left as it was, so training batches are unaffected.
+    """
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        return sampler.sample_batch(count, length)
+    finally:
+        np.random.set_state(state)
+
+
+class EpochSampler(object):
+    """Iterates over the non-overlapping windows of length tokens in a set of chunks,
+    visiting every window once per epoch in a shuffled order.
+
+    The order of each epoch depends only on the seed and the epoch number, so the
+    number of windows drawn so far (position) is all it takes to resume a run.
+    The tail of each chunk that is shorter than a window is never drawn.
+    """
+
+    def __init__(self, chunks, length, seed=0, position=0):
+        self.chunks = chunks
+        self.length = length
+        self.seed = seed
+        self.position = position
+        self.segments, self.segment, self.start, sizes = document_index(chunks)
+        self.starts = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes // length, out=self.starts[1:])
+        self.windows = int(self.starts[-1])
+        assert self.windows > 0, "Dataset files are too small to sample {} tokens at a time".format(length)
+        self.order_epoch = None
+        self.order = None
+
+    @property
+    def epoch(self):
+        return self.position // self.windows
+
+    def epoch_order(self, epoch):
+        """The shuffled window numbers of an epoch."""
+        if epoch != self.order_epoch:
+            self.order = np.random.RandomState((self.seed + epoch) % 2**32).permutation(self.windows)
+            self.order_epoch = epoch
+        return self.order
+
+    def sample_batch(self, batch_size):
+        """Return the next batch_size windows as one [batch_size, length] int32 array."""
+        batch = np.empty((batch_size, self.length), dtype=np.int32)
+        for row in range(batch_size):
+            epoch, index = divmod(self.position, self.windows)
+            window = self.epoch_order(epoch)[index]
+            document = np.searchsorted(self.starts, window, side='right') - 1
+            start = self.start[document] + (window - self.starts[document]) * self.length
+            batch[row] = self.segments[self.segment[document]][start:start + self.length]
+            self.position += 1
+        return batch
+
+    def save(self, path, position=None):
+        """Write the seed and position, by default the current one, to path."""
+        state = {
+            'seed': self.seed,
+            'windows': self.windows,
+            'position': self.position if position is None else position,
+        }
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(state, fp)
+        os.replace(path + '.tmp', path)
+
+    def restore(self, path):
+        """Continue from the state saved at path, if there is one for the same windows."""
+        if not os.path.exists(path):
+            return
+        with open(path) as fp:
+            state = json.load(fp)
+        if state['windows'] != self.windows:
+            print('Dataset now has', self.windows, 'windows instead of', state['windows'],
+                  'so the epoch starts over')
+            return
+        self.seed = state['seed']
+        self.position = state['position']
+
+
+class BatchPrefetcher(object):
+    """Makes batches on a background thread, keeping up to prefetch of them ready.
+
+    make_batch is called over and over on the thread. Iterating yields its batches in
+    order, adding the time spent waiting for one to be ready to wait_time.
+    """
+
+    def __init__(self, make_batch, prefetch=4):
+        self.make_batch = make_batch
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.wait_time = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                batch = self.make_batch()
+            except Exception as e:
+                self.queue.put(e)
+                return
+            self.queue.put(batch)
+
+    def get(self):
+        start = time.time()
+        batch = self.queue.get()
+        self.wait_time += time.time() - start
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def pop_wait_time(self):
+        """Return the time waited for batches since the last call, and reset it."""
+        wait_time, self.wait_time = self.wait_time, 0.0
+        return wait_time
+
+    def __iter__(self):
+        while True:
+            yield self.get()
@@ -144,7 +144,39 @@ def positions_for(tokens, past_length):
     return expand_tile(past_length + tf.range(nsteps), batch_size)
 
 
-def model(hparams, X, past=None, scope='model', reuse=False):
+def frozen_layers(hparams, train_blocks=None):
+    """The number of blocks below the top train_blocks, which run as inference only.
+
+    None trains every block.
+    """
+    if train_blocks is None:
+        return 0
+    if not 1 <= train_blocks <= hparams.n_layer:
+        raise ValueError('train_blocks must be between 1 and %d, not %r' % (hparams.n_layer, train_blocks))
+    return hparams.n_layer - train_blocks
+
+
+def block_variables(var_list, first_layer, scope='model'):
+    """The variables of var_list in blocks first_layer and up, or in the final layer norm.
+
+    The embeddings are only included when no block is frozen (first_layer 0), so
+    training every block trains the same variables as not freezing any.
+    """
+    def trained(var):
+        parts = var.name.split('/')
+        if parts[0] != scope:
+            return False
+        if first_layer == 0:
+            return True
+        if len(parts) < 3:
+            return False
+        if parts[1] == 'ln_f':
+            return True
+        return parts[1][:1] == 'h' and parts[1][1:].isdigit() and int(parts[1][1:]) >= first_layer
+    return [var for var in var_list if trained(var)]
+
+
+def model(hparams, X, past=None, scope='model', reuse=False, frozen_layers=0):
     with tf.variable_scope(scope, reuse=reuse):
         results = {}
         batch, sequence = shape_list(X)
@@ -161,6 +193,9 @@ def model(hparams, X, past=None, scope='model', reuse=False):
         pasts = tf.unstack(past, axis=1) if past is not None else [None] * hparams.n_layer
         assert len(pasts) == hparams.n_layer
         for layer, past in enumerate(pasts):
+            if layer == frozen_layers and layer > 0:
+                # The blocks below are not trained, so they run as inference only
+                h = tf.stop_gradient(h)
             h, present = block(h, 'h%d' % layer, past=past, hparams=hparams)
             tf.add_to_collection('checkpoints', h)
             presents.append(present)
@@ -0,0 +1,32 @@
+import resource
+
+import tensorflow as tf
+
+
+class PeakMemory(object):
+    """Reports the most memory a training run has used so far, in bytes.
+
+    This is the peak of the TensorFlow allocator of the default device, on a GPU
+    through tf.contrib.memory_stats. Where the allocator keeps no statistics, as
+    on a CPU, the peak resident set size of the process is reported instead.
+    Create it while building the graph, then call it with the session.
+    """
+
+    def __init__(self):
+        try:
+            from tensorflow.contrib.memory_stats import MaxBytesInUse
+            self.op = MaxBytesInUse()
+        except (ImportError, AttributeError):
+            self.op = None
+
+    def __call__(self, sess):
+        if self.op is not None:
+            try:
+                peak = int(sess.run(self.op))
+            except tf.errors.OpError:
+                peak = 0
+            if peak:
+                return peak
+            self.op = None
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,312 @@
+import io
+import json
+import os
+import random
+import threading
+
+import pytest
+
+import encoder
+from encoder import Encoder, get_pairs
+
+
+def reference_bpe(bpe_ranks, token):
+    """The original BPE loop: repeatedly merge every occurrence of the lowest ranked pair."""
+    word = tuple(token)
+    pairs = get_pairs(word)
+    if not pairs:
+        return token
+    while True:
+        bigram = min(pairs, key=lambda pair: bpe_ranks.get(pair, float('inf')))
+        if bigram not in bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except ValueError:
+                new_word.extend(word[i:])
+                break
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        word = tuple(new_word)
+        if len(word) == 1:
+            break
+        pairs = get_pairs(word)
+    return ' '.join(word)
+
+
+def random_encoder(rng, alphabet, n_merges):
+    """An Encoder over alphabet with n_merges random merges of existing symbols, ranked in a random order."""
+    symbols = list(alphabet)
+    merges = []
+    seen = set()
+    while len(merges) < n_merges:
+        pair = (rng.choice(symbols), rng.choice(symbols))
+        if pair in seen:
+            continue
+        seen.add(pair)
+        merges.append(pair)
+        if pair[0] + pair[1] not in symbols:
+            symbols.append(pair[0] + pair[1])
+    rng.shuffle(merges)
+    return Encoder({symbol: i for i, symbol in enumerate(symbols)}, merges, cache_size=None)
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_bpe_matches_reference_on_random_tables(seed):
+    rng = random.Random(seed)
+    alphabet = 'abcd'[:rng.randint(1, 4)]
+    enc = random_encoder(rng, alphabet, rng.randint(1, 30))
+    words = [''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 24))) for _ in range(50)]
+    words += [alphabet[0] * n for n in range(1, 17)]
+    for word in words:
+        assert enc.bpe(word) == reference_bpe(enc.bpe_ranks, word), word
+
+
+@pytest.mark.parametrize('merges', [
+    [('a', 'a')],
+    [('a', 'a'), ('aa', 'aa')],
+    [('aa', 'a'), ('a', 'a')],
+    [('a', 'a'), ('aa', 'a'), ('a', 'aa')],
+    [('a', 'b'), ('b', 'a'), ('ab', 'a'), ('a', 'ba')],
+])
+def test_bpe_matches_reference_on_overlapping_runs(merges):
+    symbols = sorted({'a', 'b'} | {first + second for first, second in merges})
+    enc = Encoder({symbol: i for i, symbol in enumerate(symbols)}, merges, cache_size=None)
+    for word in ['a' * n for n in range(1, 12)] + ['ab' * n for n in range(1, 6)] + ['aba', 'abaab', 'baaab']:
+        assert enc.bpe(word) == reference_bpe(enc.bpe_ranks, word), word
+
+
+def byte_level_encoder(merges):
+    """An Encoder with every byte as a token, plus the tokens of merges."""
+    tokens = [encoder.bytes_to_unicode()[b] for b in range(256)]
+    tokens += [first + second for first, second in merges]
+    return Encoder({token: i for i, token in enumerate(tokens)}, merges)
+
+
+CONTRACTION_MERGES = [
+    ("'", 'l'), ("'l", 'l'), ("'", 'r'), ("'r", 'e'), ("'", 'v'), ("'v", 'e'),
+    ("'", 's'), ("'", 't'), ("'", 'd'), ("'", 'm'), ('w', 'e'),
+]
+
+
+@pytest.mark.parametrize('text', [
+    "we'll",
+    "they're here, we've been, I'm sure it'll do; she'd say it's 'quoted'",
+    "a  b\n\n  c \t\n",
+    "x.'ll 123 4,5 ''ll '''",
+])
+def test_encode_stream_matches_encode_at_every_chunk_size(text):
+    enc = byte_level_encoder(CONTRACTION_MERGES)
+    expected = enc.encode(text)
+    for chunk_size in range(1, len(text) + 2):
+        assert list(enc.encode_stream(io.StringIO(text), chunk_size=chunk_size)) == expected, chunk_size
+
+
+def test_encode_stream_matches_encode_on_random_text():
+    rng = random.Random(0)
+    enc = byte_level_encoder(CONTRACTION_MERGES)
+    pieces = ["'", 'l', 'r', 'e', 'v', 's', 'we', ' ', '  ', '\n', '1', '.', 'é']
+    for _ in range(200):
+        text = ''.join(rng.choice(pieces) for _ in range(rng.randint(1, 40)))
+        expected = enc.encode(text)
+        for chunk_size in range(1, 8):
+            assert list(enc.encode_stream(io.StringIO(text), chunk_size=chunk_size)) == expected, (text, chunk_size)
+
+
+def test_incremental_decoder_matches_decode():
+    # Tokens that split multi-byte characters: é is c3 a9, € is e2 82 ac, 😀 is f0 9f 98 80
+    byte_pieces = [b'a', b'\xc3', b'\xa9', b'\xe2', b'\x82\xac', b'\xe2\x82', b'\xac b', b'\xf0\x9f', b'\x98', b'\x80', b'\xff']
+    byte_encoder = encoder.bytes_to_unicode()
+    tokens = [''.join(byte_encoder[b] for b in piece) for piece in byte_pieces]
+    enc = Encoder({token: i for i, token in enumerate(tokens)}, [])
+    rng = random.Random(0)
+    sequences = [[1, 2], [3, 4], [5, 6], [7, 8, 9], [0, 7, 8], [1], [3, 4, 7], [10, 1, 2]]
+    sequences += [[rng.randrange(len(tokens)) for _ in range(rng.randint(1, 12))] for _ in range(200)]
+    for ids in sequences:
+        decoder = enc.incremental_decoder()
+        streamed = ''.join(decoder.decode(token) for token in ids) + decoder.flush()
+        assert streamed == enc.decode(ids), ids
+        decoder.reset()
+        assert decoder.decode_tokens(ids) + decoder.flush() == enc.decode(ids), ids
+
+
+def test_incremental_decoder_holds_back_partial_characters():
+    byte_encoder = encoder.bytes_to_unicode()
+    tokens = [byte_encoder[0xe2], byte_encoder[0x82] + byte_encoder[0xac]]
+    enc = Encoder({token: i for i, token in enumerate(tokens)}, [])
+    decoder = enc.incremental_decoder()
+    assert decoder.decode(0) == ''
+    assert decoder.decode(1) == '€'
+    assert decoder.decode(0) == ''
+    # A stream cut off inside a character ends in a replacement character, as decode gives
+    assert decoder.flush() == enc.decode([0]) == '�'
+
+
+TAIL_TEXTS = [
+    '',
+    'x',
+    "x'''llama yy",
+    "we'll see  what they're doing,   I've   been\n\n here 123 4.5 ...",
+    'a' * 50 + ' ' * 7 + 'b',
+    '      leading and trailing      ',
+]
+
+
+def random_texts(rng, count):
+    pieces = ["'", 'll', 're', 've', 's', 'we', 'a', ' ', '  ', '\n', '\t', '12', '.', ',', 'é', '€']
+    return [''.join(rng.choice(pieces) for _ in range(rng.randint(0, 60))) for _ in range(count)]
+
+
+def test_encode_tail_matches_end_of_encode():
+    enc = byte_level_encoder(CONTRACTION_MERGES)
+    for text in TAIL_TEXTS + random_texts(random.Random(1), 300):
+        expected = enc.encode(text)
+        for max_tokens in range(0, len(expected) + 3):
+            assert enc.encode_tail(text, max_tokens) == (expected[-max_tokens:] if max_tokens else []), (text, max_tokens)
+
+
+def test_count_tokens_matches_encode():
+    enc = byte_level_encoder(CONTRACTION_MERGES)
+    for text in TAIL_TEXTS + random_texts(random.Random(2), 300):
+        count = len(enc.encode(text))
+        assert enc.count_tokens(text) == count, text
+        for limit in range(0, count + 2):
+            limited = enc.count_tokens(text, limit=limit)
+            if count <= limit:
+                assert limited == count, (text, limit)
+            else:
+                assert limit < limited <= count, (text, limit)
+
+
+def test_shared_cache_survives_concurrent_encodes():
+    enc = byte_level_encoder(CONTRACTION_MERGES)
+    texts = random_texts(random.Random(3), 200)
+    expected = [enc.encode(text) for text in texts]
+    # A cache far smaller than the traffic keeps evicting under every thread
+    enc.cache = encoder.LRUCache(4)
+    errors = []
+
+    def work(seed):
+        order = list(range(len(texts)))
+        random.Random(seed).shuffle(order)
+        try:
+            for i in order * 5:
+                assert enc.encode(texts[i]) == expected[i]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    info = enc.cache_info()
+    assert info.currsize <= 4
+    assert info.hits + info.misses > 0
+
+
+def write_text_encoder(model_dir, merges):
+    """Write encoder.json and vocab.bpe for the byte-level vocabulary plus merges, as OpenAI ships them."""
+    tokens = [encoder.bytes_to_unicode()[b] for b in range(256)]
+    tokens += [first + second for first, second in merges] + ['<|endoftext|>']
+    os.makedirs(model_dir, exist_ok=True)
+    with open(os.path.join(model_dir, 'encoder.json'), 'w') as f:
+        json.dump({token: i for i, token in enumerate(tokens)}, f)
+    with open(os.path.join(model_dir, 'vocab.bpe'), 'w', encoding='utf-8') as f:
+        f.write('#version: 0.2\n' + ''.join('%s %s\n' % merge for merge in merges))
+
+
+def set_mtime(path, stamp):
+    os.utime(path, (stamp, stamp))
+
+
+def test_compiled_encoder_matches_text_encoder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    model_dir = os.path.join('models', 'tiny')
+    write_text_encoder(model_dir, CONTRACTION_MERGES)
+    encoder.compile_encoder('tiny')
+    compiled = os.path.join(model_dir, encoder.COMPILED_ENCODER)
+    for name in ('encoder.json', 'vocab.bpe'):
+        set_mtime(os.path.join(model_dir, name), 1000000000)
+
+    text_vocab, text_merges = encoder.load_text_encoder(model_dir)
+    assert encoder.load_compiled_encoder(compiled) == (text_vocab, text_merges)
+    enc = encoder.get_encoder('tiny')
+    assert enc.encoder == text_vocab
+    assert enc.bpe_merges == text_merges
+    assert enc.encode("we'll") == Encoder(text_vocab, text_merges).encode("we'll")
+
+
+def test_get_encoder_reads_text_files_newer_than_the_compiled_encoder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    model_dir = os.path.join('models', 'tiny')
+    write_text_encoder(model_dir, CONTRACTION_MERGES)
+    encoder.compile_encoder('tiny')
+    set_mtime(os.path.join(model_dir, encoder.COMPILED_ENCODER), 1000000000)
+
+    # Edited after compiling: one more merge and its token
+    write_text_encoder(model_dir, CONTRACTION_MERGES + [('z', 'z')])
+    for name in ('encoder.json', 'vocab.bpe'):
+        set_mtime(os.path.join(model_dir, name), 1000000010)
+    enc = encoder.get_encoder('tiny')
+    assert (enc.encoder, enc.bpe_merges) == encoder.load_text_encoder(model_dir)
+    assert 'zz' in enc.encoder and enc.bpe_merges[-1] == ('z', 'z')
+
+
+def test_load_compiled_encoder_rejects_a_bad_magic(tmp_path):
+    path = str(tmp_path / encoder.COMPILED_ENCODER)
+    with open(path, 'wb') as f:
+        f.write(encoder.COMPILED_HEADER.pack(b'NOTBPE00', 0, 0, 0))
+    with pytest.raises(ValueError, match='not a compiled encoder'):
+        encoder.load_compiled_encoder(path)
+
+
+@pytest.mark.parametrize('count', [0, 1, 2, 37])
+def test_encode_batch_matches_encode_in_order(count):
+    enc = byte_level_encoder(CONTRACTION_MERGES)
+    texts = random_texts(random.Random(4), count)
+    expected = [enc.encode(text) for text in texts]
+    assert enc.encode_batch(texts, workers=2) == expected
+    assert enc.encode_batch(iter(texts), workers=2, chunksize=3) == expected
+
+
+def test_encode_batch_reuses_a_pool_it_is_given():
+    enc = byte_level_encoder(CONTRACTION_MERGES)
+    texts = random_texts(random.Random(5), 20)
+    with enc.pool(2) as pool:
+        for batch in (texts[:7], texts[7:], []):
+            assert enc.encode_batch(batch, pool=pool) == [enc.encode(text) for text in batch]
+
+
+def test_lru_cache_evicts_the_least_recently_used_key():
+    cache = encoder.LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.info() == encoder.CacheInfo(hits=3, misses=1, evictions=1, maxsize=2, currsize=2)
+
+    cache.clear()
+    assert cache.info() == encoder.CacheInfo(hits=0, misses=0, evictions=0, maxsize=2, currsize=0)
+
+
+def test_unbounded_lru_cache_never_evicts():
+    cache = encoder.LRUCache(None)
+    for i in range(1000):
+        cache[i] = i
+    assert all(cache.get(i) == i for i in range(1000))
+    assert cache.get(1000, 'missing') == 'missing'
+    assert cache.info() == encoder.CacheInfo(hits=1000, misses=1, evictions=0, maxsize=None, currsize=1000)
@@ -0,0 +1,376 @@
+import itertools
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import load_dataset
+from load_dataset import (list_paths, write_token_store, load_token_store, documents, TokenStore,
+                          Sampler, EpochSampler, MixtureSampler, BatchPrefetcher, parse_mixture, pack_chunks, load_file, CACHE_DIR,
+                          encode_dataset_dir, load_dataset_dir, read_manifest, write_manifest, MANIFEST)
+from test_encoder import byte_level_encoder
+
+
+def write(path, text='x'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fp:
+        fp.write(text)
+
+
+def test_list_paths_walks_in_sorted_order(tmp_path):
+    names = ['b/z.txt', 'b/a.txt', 'a/c/y.txt', 'a/m.txt', 'c.txt', 'a.txt']
+    for name in names:
+        write(str(tmp_path / name))
+    found = [os.path.relpath(p, str(tmp_path)) for p in list_paths(str(tmp_path))]
+    assert found == ['a.txt', 'c.txt', 'a/m.txt', 'a/c/y.txt', 'b/a.txt', 'b/z.txt']
+
+
+def test_list_paths_skips_parts_of_other_inputs_in_globs(tmp_path):
+    for name in ['a.txt', 'a.tokens.npy', 'a.offsets.npy', MANIFEST, '.token_cache/a.txt.0.0.tokens.npy']:
+        write(str(tmp_path / name))
+    for pattern in ['*', '.*', '*.npy', '**/*', '.token_cache/*']:
+        found = [os.path.relpath(p, str(tmp_path)) for p in list_paths(str(tmp_path / pattern))]
+        assert 'a.offsets.npy' not in found and MANIFEST not in found, pattern
+        assert not any(p.startswith('.token_cache') for p in found), pattern
+    assert list_paths(str(tmp_path / '*.npy')) == [str(tmp_path / 'a.tokens.npy')]
+
+
+def test_list_paths_loads_nested_dataset_directories_whole(tmp_path):
+    for name in ['a.txt', 'data/shard-00000.tokens.npy', 'data/shard-00000.offsets.npy',
+                 'data/sub/b.txt', 'z/c.txt']:
+        write(str(tmp_path / name))
+    write_manifest(str(tmp_path / 'data'), read_manifest(str(tmp_path / 'data')))
+    found = [os.path.relpath(p, str(tmp_path)) for p in list_paths(str(tmp_path))]
+    assert found == ['a.txt', 'data', 'z/c.txt']
+
+
+def test_list_paths_walks_directories_whose_manifest_is_not_a_dataset_manifest(tmp_path):
+    # A scraped app's manifest.json, and a file that only shares the manifest's name
+    write(str(tmp_path / 'app/manifest.json'), '{"name": "app"}')
+    write(str(tmp_path / 'app/page.txt'))
+    write(str(tmp_path / 'other' / MANIFEST), '{"files": {}}')
+    write(str(tmp_path / 'other/page.txt'))
+    found = [os.path.relpath(p, str(tmp_path)) for p in list_paths(str(tmp_path))]
+    assert found == ['app/manifest.json', 'app/page.txt', 'other/page.txt']
+    enc = byte_level_encoder([])
+    assert [enc.decode(doc.tolist()) for doc in documents(load_dataset.load_dataset(enc, str(tmp_path)))] == [
+        '{"name": "app"}', 'x', 'x']
+
+
+def random_documents(rng, count, max_size=40):
+    return [rng.randint(0, 50257, size=rng.randint(0, max_size)).astype(np.uint16) for _ in range(count)]
+
+
+def store_with(tmp_path, chunks, name='a.tokens.npy'):
+    path = str(tmp_path / name)
+    write_token_store(path, chunks)
+    return load_token_store(path)
+
+
+def assert_same_documents(chunks, expected):
+    got = list(documents(chunks))
+    assert len(got) == len(expected)
+    for a, b in zip(got, expected):
+        assert a.tolist() == b.tolist()
+
+
+def test_token_store_round_trip_and_slicing(tmp_path):
+    rng = np.random.RandomState(0)
+    docs = random_documents(rng, 30)
+    store = store_with(tmp_path, docs)
+    assert isinstance(store, TokenStore) and len(store) == 30
+    assert_same_documents([store], docs)
+    assert store[-1].tolist() == docs[-1].tolist()
+    assert_same_documents([store[5:12]], docs[5:12])
+    assert_same_documents([store[12:5]], [])
+    # Stores and plain arrays mixed, as load_dataset returns them
+    mixed = [docs[0], store[3:9], docs[1], store[20:]]
+    expected = [docs[0]] + docs[3:9] + [docs[1]] + docs[20:]
+    assert_same_documents([store_with(tmp_path, mixed, 'b.tokens.npy')], expected)
+
+
+def test_samplers_draw_the_same_windows_from_stores_as_from_documents(tmp_path):
+    rng = np.random.RandomState(1)
+    docs = random_documents(rng, 50)
+    store = store_with(tmp_path, docs)
+    chunks = [docs[0], store[1:25], docs[25], store[26:]]
+    for length in [1, 5, 20]:
+        a = Sampler(chunks).sample_batch(64, length, rng=np.random.RandomState(length))
+        b = Sampler(docs).sample_batch(64, length, rng=np.random.RandomState(length))
+        assert a.tolist() == b.tolist()
+        a, b = EpochSampler(chunks, length, seed=3), EpochSampler(docs, length, seed=3)
+        assert a.windows == b.windows
+        assert a.sample_batch(2 * a.windows).tolist() == b.sample_batch(2 * b.windows).tolist()
+
+
+def test_pack_chunks_expands_token_stores(tmp_path):
+    rng = np.random.RandomState(2)
+    docs = random_documents(rng, 20)
+    packed = pack_chunks([store_with(tmp_path, docs)], 50256, 30)
+    assert [t.tolist() for t in packed] == [t.tolist() for t in pack_chunks(docs, 50256, 30)]
+
+
+def test_cached_files_are_only_hashed_again_when_size_or_mtime_change(tmp_path, monkeypatch):
+    enc = byte_level_encoder([])
+    hashed = []
+    file_digest = load_dataset.file_digest
+    monkeypatch.setattr(load_dataset, 'file_digest', lambda path: hashed.append(path) or file_digest(path))
+    path = str(tmp_path / 'a.txt')
+    write(path, 'hello world')
+    stamp = os.stat(path).st_mtime
+
+    def load():
+        return [doc.tolist() for doc in documents(load_file(enc, path, cache=True))]
+
+    assert load() == [enc.encode('hello world')]
+    assert load() == [enc.encode('hello world')]
+    assert len(hashed) == 1
+
+    # Touched: hashed again, but the cached store still serves
+    os.utime(path, (stamp + 10, stamp + 10))
+    assert load() == [enc.encode('hello world')]
+    assert load() == [enc.encode('hello world')]
+    assert len(hashed) == 2
+
+    # Edited: a new store replaces the old one
+    write(path, 'goodbye')
+    os.utime(path, (stamp + 20, stamp + 20))
+    assert load() == [enc.encode('goodbye')]
+    assert len(hashed) == 3
+    stores = [f for f in os.listdir(str(tmp_path / CACHE_DIR)) if f.endswith(load_dataset.TOKENS_SUFFIX)]
+    assert len(stores) == 1
+
+
+def test_cached_file_loads_when_a_stale_store_is_already_half_removed(tmp_path):
+    enc = byte_level_encoder([])
+    path = str(tmp_path / 'a.txt')
+    write(path, 'hello world')
+    stamp = os.stat(path).st_mtime
+    load_file(enc, path, cache=True)
+    cache_dir = str(tmp_path / CACHE_DIR)
+    for name in os.listdir(cache_dir):
+        if name.endswith(load_dataset.OFFSETS_SUFFIX):
+            os.remove(os.path.join(cache_dir, name))
+
+    write(path, 'goodbye')
+    os.utime(path, (stamp + 20, stamp + 20))
+    assert [doc.tolist() for doc in documents(load_file(enc, path, cache=True))] == [enc.encode('goodbye')]
+    stores = [f for f in os.listdir(cache_dir) if f.endswith(load_dataset.TOKENS_SUFFIX)]
+    assert len(stores) == 1
+
+
+class DatasetDir(object):
+    """Source files under tmp_path/src encoded into the dataset directory tmp_path/out."""
+
+    def __init__(self, tmp_path):
+        self.enc = byte_level_encoder([])
+        self.src = str(tmp_path / 'src')
+        self.out = str(tmp_path / 'out')
+        self.stamp = 1000000000
+
+    def write(self, name, text):
+        path = os.path.join(self.src, name)
+        write(path, text)
+        # A distinct mtime for every write, as the filesystem may not resolve them
+        self.stamp += 10
+        os.utime(path, (self.stamp, self.stamp))
+
+    def encode(self, **kwargs):
+        shards = len(read_manifest(self.out)['shards'])
+        encode_dataset_dir(self.enc, self.src, self.out, '117M', **kwargs)
+        return len(read_manifest(self.out)['shards']) - shards
+
+    def texts(self):
+        return [self.enc.decode(doc.tolist()) for doc in documents(load_dataset_dir(self.out))]
+
+
+def test_encode_dataset_dir_encodes_only_new_and_changed_files(tmp_path):
+    data = DatasetDir(tmp_path)
+    data.write('a.txt', 'alpha')
+    data.write('b.txt', 'bravo')
+    data.write('c.txt', 'charlie')
+    assert data.encode() == 1
+    assert data.texts() == ['alpha', 'bravo', 'charlie']
+
+    # Unchanged
+    assert data.encode() == 0
+    assert data.texts() == ['alpha', 'bravo', 'charlie']
+
+    # Touched: the same contents with a new mtime are not encoded again
+    path = os.path.join(data.src, 'b.txt')
+    os.utime(path, (data.stamp + 5, data.stamp + 5))
+    assert data.encode() == 0
+    assert read_manifest(data.out)['files'][path]['mtime'] == data.stamp + 5
+
+    # Edited and added; the old documents of b.txt stay in the first shard unused
+    data.write('b.txt', 'bravo two')
+    data.write('d.txt', 'delta')
+    assert data.encode() == 1
+    assert data.texts() == ['alpha', 'bravo two', 'charlie', 'delta']
+    assert [data.enc.decode(doc.tolist()) for doc in documents(load_file(data.enc, os.path.join(
+        data.out, 'shard-00000.tokens.npy')))] == ['alpha', 'charlie']
+
+    # Removed
+    os.remove(os.path.join(data.src, 'a.txt'))
+    assert data.encode() == 0
+    assert data.texts() == ['bravo two', 'charlie', 'delta']
+
+
+def test_encode_dataset_dir_skips_itself_and_rejects_other_dataset_dirs(tmp_path):
+    data = DatasetDir(tmp_path)
+    data.write('a.txt', 'alpha')
+    # Encoded into a directory inside its own sources, then again over the result
+    data.out = os.path.join(data.src, 'enc')
+    assert data.encode() == 1
+    assert data.encode() == 0
+    data.write('b.txt', 'bravo')
+    assert data.encode() == 1
+    assert data.texts() == ['alpha', 'bravo']
+    assert all(not source.startswith(data.out) for source in read_manifest(data.out)['files'])
+
+    # Another dataset directory is already encoded, not a source
+    other = str(tmp_path / 'other')
+    with pytest.raises(ValueError, match='dataset directory'):
+        encode_dataset_dir(data.enc, data.src, other, '117M')
+    assert not os.path.exists(other)
+
+
+def test_encode_dataset_dir_resumes_after_a_shard_missing_from_the_manifest(tmp_path):
+    data = DatasetDir(tmp_path)
+    data.write('a.txt', 'alpha')
+    assert data.encode() == 1
+    manifest = read_manifest(data.out)
+
+    # Interrupted after writing the shard of b.txt but before recording it
+    data.write('b.txt', 'bravo')
+    data.write('c.txt', 'charlie')
+    assert data.encode(shard_files=1) == 2
+    os.remove(os.path.join(data.out, 'shard-00002.tokens.npy'))
+    os.remove(os.path.join(data.out, 'shard-00002.offsets.npy'))
+    write_manifest(data.out, manifest)
+
+    assert data.encode(shard_files=1) == 2
+    assert data.texts() == ['alpha', 'bravo', 'charlie']
+    assert read_manifest(data.out)['shards'] == ['shard-00000', 'shard-00001', 'shard-00002']
+
+
+def numbered_chunks():
+    """Chunks of 25, 7 and 30 distinct tokens: 5 + 1 + 6 windows of 5 tokens."""
+    return [np.arange(0, 25, dtype=np.uint16), np.arange(100, 107, dtype=np.uint16),
+            np.arange(200, 230, dtype=np.uint16)]
+
+
+def test_epoch_sampler_draws_every_window_once_per_epoch():
+    sampler = EpochSampler(numbered_chunks(), 5, seed=3)
+    assert sampler.windows == 12
+    expected = sorted(list(range(0, 25, 5)) + [100] + list(range(200, 230, 5)))
+    orders = []
+    for epoch in range(2):
+        batch = sampler.sample_batch(sampler.windows)
+        assert (np.diff(batch, axis=1) == 1).all()
+        assert sorted(batch[:, 0].tolist()) == expected
+        orders.append(batch[:, 0].tolist())
+        assert sampler.epoch == epoch + 1
+    assert orders[0] != orders[1]
+
+
+def test_epoch_sampler_resumes_with_the_same_batches(tmp_path):
+    path = str(tmp_path / 'epoch')
+    uninterrupted = EpochSampler(numbered_chunks(), 5, seed=3)
+    interrupted = EpochSampler(numbered_chunks(), 5, seed=3)
+    interrupted.sample_batch(5)
+    interrupted.save(path)
+
+    resumed = EpochSampler(numbered_chunks(), 5)
+    resumed.restore(path)
+    assert (resumed.seed, resumed.position) == (3, 5)
+    uninterrupted.sample_batch(5)
+    # Across the end of the first epoch and into the next
+    for _ in range(4):
+        assert resumed.sample_batch(5).tolist() == uninterrupted.sample_batch(5).tolist()
+
+
+def test_epoch_sampler_starts_over_when_the_windows_change(tmp_path):
+    path = str(tmp_path / 'epoch')
+    sampler = EpochSampler(numbered_chunks(), 5, seed=3)
+    sampler.sample_batch(7)
+    sampler.save(path)
+
+    grown = EpochSampler(numbered_chunks() + [np.arange(300, 310, dtype=np.uint16)], 5)
+    grown.restore(path)
+    assert grown.windows == 14
+    assert (grown.seed, grown.position) == (0, 0)
+
+
+def test_parse_mixture():
+    assert parse_mixture('a:0.7,b:0.3') == [('a', 0.7), ('b', 0.3)]
+    assert parse_mixture('a') == [('a', 1.0)]
+    # What fire passes for --dataset a,b
+    assert parse_mixture(('a', 'b:2')) == [('a', 1.0), ('b', 2.0)]
+    # A colon that does not introduce a weight is part of the path
+    assert parse_mixture('C:/data/x.txt,runs/v1:final/y.txt:0.5') == [
+        ('C:/data/x.txt', 1.0), ('runs/v1:final/y.txt', 0.5)]
+
+
+def test_mixture_sampler_rejects_weights_without_a_positive_total():
+    samplers = [Sampler(numbered_chunks()), Sampler(numbered_chunks())]
+    MixtureSampler(samplers, [0, 1])
+    for weights in ([0, 0], [1, -0.5], [1]):
+        with pytest.raises(AssertionError):
+            MixtureSampler(samplers, weights)
+
+
+def test_mixture_sampler_draws_by_weight_rather_than_size():
+    small = Sampler([np.arange(0, 20, dtype=np.uint16)])
+    large = Sampler([np.arange(1000, 3000, dtype=np.uint16)])
+    mixture = MixtureSampler([small, large], [0.7, 0.3])
+    batch = mixture.sample_batch(10000, 5, rng=np.random.RandomState(0))
+    assert (np.diff(batch, axis=1) == 1).all()
+    from_small = np.mean(batch[:, 0] < 1000)
+    assert abs(from_small - 0.7) < 0.02
+    # The same seed draws the same rows
+    assert (mixture.sample_batch(100, 5, rng=np.random.RandomState(1)) ==
+            mixture.sample_batch(100, 5, rng=np.random.RandomState(1))).all()
+
+
+def test_batch_prefetcher_keeps_batch_order():
+    counter = itertools.count()
+    prefetcher = BatchPrefetcher(lambda: next(counter), prefetch=3)
+    assert [prefetcher.get() for _ in range(10)] == list(range(10))
+    assert list(itertools.islice(prefetcher, 5)) == list(range(10, 15))
+
+
+def test_batch_prefetcher_accumulates_and_resets_wait_time():
+    ready = threading.Event()
+    counter = itertools.count()
+
+    def make_batch():
+        ready.wait()
+        return next(counter)
+
+    prefetcher = BatchPrefetcher(make_batch, prefetch=1)
+    timer = threading.Timer(0.1, ready.set)
+    timer.start()
+    assert prefetcher.get() == 0
+    assert prefetcher.get() == 1
+    wait_time = prefetcher.pop_wait_time()
+    assert wait_time >= 0.09
+    assert prefetcher.pop_wait_time() == 0.0
+    timer.join()
+
+
+def test_batch_prefetcher_raises_make_batch_errors_in_get():
+    batches = iter([0, 1])
+
+    def make_batch():
+        try:
+            return next(batches)
+        except StopIteration:
+            raise ValueError('out of batches')
+
+    prefetcher = BatchPrefetcher(make_batch, prefetch=4)
+    assert prefetcher.get() == 0
+    assert prefetcher.get() == 1
+    with pytest.raises(ValueError, match='out of batches'):
+        prefetcher.get()
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+model = pytest.importorskip('model')
+
+
+def tiny_hparams():
+    hparams = model.default_hparams()
+    hparams.override_from_dict(dict(n_vocab=16, n_ctx=8, n_embd=8, n_head=2, n_layer=3))
+    return hparams
+
+
+TOKENS = np.array([[1, 3, 3, 5, 7, 2]], dtype=np.int32)
+
+
+def wte_gradient(train_blocks):
+    """The gradient of the language model loss on TOKENS for wte, and the variables trained."""
+    hparams = tiny_hparams()
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        frozen = model.frozen_layers(hparams, train_blocks)
+        context = tf.constant(TOKENS)
+        logits = model.model(hparams=hparams, X=context, frozen_layers=frozen)['logits']
+        loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=context[:, 1:], logits=logits[:, :-1]))
+        all_vars = tf.trainable_variables()
+        train_vars = all_vars if train_blocks is None else model.block_variables(all_vars, frozen)
+        names = [v.name for v in all_vars]
+        grads = dict(zip(names, tf.gradients(loss, all_vars)))
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            wte = sess.run(tf.convert_to_tensor(grads['model/wte:0']))
+        return wte, grads, [v.name for v in train_vars]
+
+
+def test_frozen_blocks_get_no_gradient():
+    _, grads, train_vars = wte_gradient(train_blocks=1)
+    for name, grad in grads.items():
+        below = name.startswith(('model/h0/', 'model/h1/', 'model/wpe'))
+        assert (grad is None) == below, name
+    assert train_vars and all(name.startswith(('model/h2/', 'model/ln_f/')) for name in train_vars)
+
+
+def test_frozen_wte_gradient_is_only_the_output_projection():
+    frozen, _, _ = wte_gradient(train_blocks=1)
+    full, _, _ = wte_gradient(train_blocks=None)
+    # The output projection term is the same in both; only the rows of the input
+    # tokens also get the embedding term, and only when nothing is frozen
+    inputs = np.unique(TOKENS)
+    others = np.setdiff1d(np.arange(frozen.shape[0]), inputs)
+    np.testing.assert_allclose(frozen[others], full[others], rtol=1e-5, atol=1e-7)
+    assert not np.allclose(frozen[inputs], full[inputs])
+
+
+def test_training_every_block_trains_the_embeddings_too():
+    _, _, train_vars = wte_gradient(train_blocks=3)
+    _, _, all_vars = wte_gradient(train_blocks=None)
+    assert train_vars == all_vars
+
+
+WINDOWS = np.array([[1, 3, 3, 5, 7, 2], [4, 4, 9, 1, 0, 6], [2, 8, 8, 3, 1, 5], [7, 6, 5, 4, 3, 2]], dtype=np.int32)
+
+
+def train_steps(batch_size, accumulate_gradients, make_optimizer, steps=2, initial=None):
+    """Losses and variable values after steps optimizer steps on WINDOWS, split
+    into micro-batches of batch_size, starting from the values in initial."""
+    from accumulate import build_train_ops, run_train_step
+    hparams = tiny_hparams()
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        context = tf.placeholder(tf.int32, [batch_size, None])
+        # Resource variables, so that the single batch step cannot update a weight
+        # before the gradients of the layers below it have read it
+        with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+            logits = model.model(hparams=hparams, X=context)['logits']
+        loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=context[:, 1:], logits=logits[:, :-1]))
+        train_vars = tf.trainable_variables()
+        grads = dict(zip([v.name for v in train_vars], tf.gradients(loss, train_vars)))
+        assert isinstance(grads['model/wpe:0'], tf.IndexedSlices)
+        train_ops = build_train_ops(make_optimizer(), loss, train_vars, accumulate_gradients=accumulate_gradients)
+        batches = iter(np.tile(WINDOWS, (steps, 1)).reshape(-1, batch_size, WINDOWS.shape[1]))
+        feed = lambda: {context: next(batches)}
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            if initial is not None:
+                for var in train_vars:
+                    var.load(initial[var.name], sess)
+            values = {var.name: value for var, value in zip(train_vars, sess.run(train_vars))}
+            losses = [run_train_step(sess, train_ops, accumulate_gradients, feed=feed) for _ in range(steps)]
+            updated = {var.name: value for var, value in zip(train_vars, sess.run(train_vars))}
+    return values, losses, updated
+
+
+@pytest.mark.parametrize('make_optimizer', [
+    lambda: tf.train.GradientDescentOptimizer(0.5),
+    lambda: tf.train.MomentumOptimizer(0.5, momentum=0.9),
+])
+def test_accumulated_micro_batches_match_one_large_batch(make_optimizer):
+    n = WINDOWS.shape[0]
+    initial, accumulated_losses, accumulated = train_steps(1, n, make_optimizer)
+    _, batch_losses, batched = train_steps(n, 1, make_optimizer, initial=initial)
+    # The mean loss of the micro-batches is the loss of the batch they make up
+    np.testing.assert_allclose(accumulated_losses, batch_losses, rtol=1e-5)
+    for name, value in batched.items():
+        np.testing.assert_allclose(accumulated[name], value, rtol=1e-4, atol=1e-6, err_msg=name)
+    # wpe is only gathered, so its gradient is accumulated through scatter_add
+    assert not np.allclose(accumulated['model/wpe:0'], initial['model/wpe:0'])
@@ -1,18 +1,27 @@
 #!/usr/bin/env python3
 # Usage:
 #  PYTHONPATH=src ./train --dataset <file|directory|glob>
+# Several datasets are mixed by weight, rather than by size, with:
+#  PYTHONPATH=src ./train --dataset <dataset>:0.7,<dataset>:0.3
+# Datasets of short documents can be packed, joined by <|endoftext|>, with:
+#  PYTHONPATH=src ./train --dataset <file|directory|glob> --combine 1024
+# Only the top N blocks and the final layer norm are trained, with the embeddings
+# (wte, wpe) left as they are unless N is the model's number of layers, with:
+#  PYTHONPATH=src ./train --dataset <file|directory|glob> --train_blocks N
 
 import fire
 import json
 import os
 import numpy as np
 import tensorflow as tf
-import random
 import time
 
 import model
 import sample
 import encoder
+from load_dataset import load_sampler
+from accumulate import build_train_ops, run_train_step
+from peak_memory import PeakMemory
 
 CHECKPOINT_DIR = 'checkpoint'
 SAMPLE_DIR = 'samples'
@@ -25,74 +34,6 @@ def maketree(path):
         pass
 
 
-def load_dataset(enc, path):
-    paths = []
-    if os.path.isfile(path):
-        # Simple file
-        paths.append(path)
-    elif os.path.isdir(path):
-        # Directory
-        for (dirpath, _, fnames) in os.walk(path):
-            for fname in fnames:
-                paths.append(os.path.join(dirpath, fname))
-    else:
-        # Assume glob
-        paths = glob.glob(path)
-
-    token_chunks = []
-    for path in paths:
-        print('Reading', path)
-        if path.endswith('.npz'):
-            # Pre-encoded
-            with np.load(path) as npz:
-                for item in npz.files:
-                    token_chunks.append(npz[item])
-        else:
-            with open(path, 'r') as fp:
-                raw_text = fp.read()
-            tokens = np.stack(enc.encode(raw_text))
-            token_chunks.append(tokens)
-    return token_chunks
-
-
-def binary_search(f, lo, hi):
-    if f(lo) or not f(hi):
-        return None
-    while hi > lo + 1:
-        mid = (lo + hi) // 2
-        if f(mid):
-            hi = mid
-        else:
-            lo = mid
-    return hi
-
-
-class Sampler(object):
-    """Fairly samples a slice from a set of variable sized chunks.
-
-    'Fairly' means that the distribution is the same as sampling from one concatenated chunk,
-    but without crossing chunk boundaries."""
-
-    def __init__(self, chunks):
-        self.chunks = chunks
-        self.total_size = sum(chunk.shape[0] for chunk in chunks)
-        self.boundaries = [0]
-        for i in range(len(chunks)):
-            self.boundaries.append(self.boundaries[-1] + chunks[i].shape[0])
-
-    def sample(self, length):
-        assert length < self.total_size // len(
-            self.chunks
-        ), "Dataset files are too small to sample {} tokens at a time".format(length)
-        while True:
-            index = random.randint(0, self.total_size - length - 1)
-            i = binary_search(lambda j: self.boundaries[j] > index, 0,
-                              len(self.boundaries) - 1) - 1
-            if self.boundaries[i + 1] > index + length:
-                within_chunk = index - self.boundaries[i]
-                return self.chunks[i][within_chunk:within_chunk + length]
-
-
 def train_main(dataset,
                model_name='345M',
                seed=None,
@@ -107,7 +48,11 @@ def train_main(dataset,
                beta1=0.9,
                beta2=0.999,
                epsilon=1e-08,
-               save_every=1000):
+               save_every=1000,
+               combine=None,
+               accumulate_gradients=1,
+               memory_saving_gradients='off',
+               train_blocks=None):
 
     enc = encoder.get_encoder(model_name)
     hparams = model.default_hparams()
@@ -120,13 +65,15 @@ def train_main(dataset,
         raise ValueError(
             "Can't get samples longer than window size: %s" % hparams.n_ctx)
 
+    frozen_layers = model.frozen_layers(hparams, train_blocks)
+
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
     with tf.Session(config=config) as sess:
         context = tf.placeholder(tf.int32, [batch_size, None])
         np.random.seed(seed)
         tf.set_random_seed(seed)
-        output = model.model(hparams=hparams, X=context)
+        output = model.model(hparams=hparams, X=context, frozen_layers=frozen_layers)
         loss = tf.reduce_mean(
             tf.nn.sparse_softmax_cross_entropy_with_logits(
                 labels=context[:, 1:], logits=output['logits'][:, :-1]))
@@ -139,16 +86,20 @@ def train_main(dataset,
             temperature=1.0,
             top_k=40)
 
-        train_vars = [v for v in tf.trainable_variables() if 'model' in v.name]
+        all_vars = [v for v in tf.trainable_variables() if 'model' in v.name]
+        train_vars = all_vars
+        if train_blocks is not None:
+            train_vars = model.block_variables(all_vars, frozen_layers)
+            print("Training the top", train_blocks, "blocks out of", hparams.n_layer)
         opt = tf.train.AdamOptimizer(learning_rate=learning_rate,
                                      beta1=beta1,
                                      beta2=beta2,
-                                     epsilon=epsilon
-                                     ).minimize(loss,
-                                                var_list=train_vars)
+                                     epsilon=epsilon)
+        train_ops = build_train_ops(opt, loss, train_vars, memory_saving_gradients, accumulate_gradients)
+        peak_memory = PeakMemory()
 
         saver = tf.train.Saver(
-            var_list=train_vars,
+            var_list=all_vars,
             max_to_keep=5,
             keep_checkpoint_every_n_hours=2)
         sess.run(tf.global_variables_initializer())
@@ -169,9 +120,9 @@ def train_main(dataset,
         saver.restore(sess, ckpt)
 
         print('Loading dataset...')
-        chunks = load_dataset(enc, dataset)
-        data_sampler = Sampler(chunks)
+        data_sampler = load_sampler(enc, dataset, combine=combine, length=1024, cache=True)
         print('dataset has', data_sampler.total_size, 'tokens')
+        print('dataset has', data_sampler.windows(1024), 'windows of', 1024, 'tokens to sample from')
         print('Training...')
 
         counter = 1
@@ -226,19 +177,22 @@ def train_main(dataset,
                 if counter % sample_every == 0:
                     generate_samples()
 
-                batch = [data_sampler.sample(1024) for _ in range(batch_size)]
-
-                _, lv = sess.run((opt, loss), feed_dict={context: batch})
+                step_start = time.time()
+                lv = run_train_step(sess, train_ops, accumulate_gradients,
+                                    feed=lambda: {context: data_sampler.sample_batch(batch_size, 1024)})
+                step_time = time.time() - step_start
 
                 avg_loss = (avg_loss[0] * 0.99 + lv, avg_loss[1] * 0.99 + 1.0)
 
                 print(
-                    '[{counter} | {time:2.2f}] loss={loss:2.2f} avg={avg:2.2f}'
+                    '[{counter} | {time:2.2f}] loss={loss:2.2f} avg={avg:2.2f} step={step:2.2f}s peak={peak:2.0f}MB'
                     .format(
                         counter=counter,
                         time=time.time() - start_time,
                         loss=lv,
-                        avg=avg_loss[0] / avg_loss[1]))
+                        avg=avg_loss[0] / avg_loss[1],
+                        step=step_time,
+                        peak=peak_memory(sess) / 2**20))
 
                 counter += 1
         except KeyboardInterrupt:
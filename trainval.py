@@ -1,19 +1,29 @@
 #!/usr/bin/env python3
 # Usage:
 #  PYTHONPATH=src ./train --dataset <file|directory|glob>
+# Several datasets are mixed by weight, rather than by size, with:
+#  PYTHONPATH=src ./train --dataset <dataset>:0.7,<dataset>:0.3
+# Datasets of short documents can be packed, joined by <|endoftext|>, with:
+#  PYTHONPATH=src ./train --dataset <file|directory|glob> --combine 1024
+# Only the top N blocks and the final layer norm are trained, with the embeddings
+# (wte, wpe) left as they are unless N is the model's number of layers, with:
+#  PYTHONPATH=src ./train --dataset <file|directory|glob> --train_blocks N
+# Exact validation on a fixed set of 40 batches of 8 windows every 100 steps:
+#  PYTHONPATH=src ./trainval.py --dataset <dataset> --valset <dataset> --val_batch_count 40 --val_batch_size 8 --val_every 100
 
 import fire
 import json
 import os
-import glob
 import numpy as np
 import tensorflow as tf
-import random
 import time
 
 import model
 import sample
 import encoder
+from load_dataset import load_sampler, validation_windows, Sampler, EpochSampler, BatchPrefetcher
+from accumulate import build_train_ops, run_train_step
+from peak_memory import PeakMemory
 
 CHECKPOINT_DIR = 'checkpoint'
 SAMPLE_DIR = 'samples'
@@ -26,73 +36,6 @@ def maketree(path):
         pass
 
 
-def load_dataset(enc, path):
-    paths = []
-    if os.path.isfile(path):
-        # Simple file
-        paths.append(path)
-    elif os.path.isdir(path):
-        # Directory
-        for (dirpath, _, fnames) in os.walk(path):
-            for fname in fnames:
-                paths.append(os.path.join(dirpath, fname))
-    else:
-        paths = glob.glob(path)
-
-    token_chunks = []
-    for path in paths:
-        print('Reading', path)
-        if path.endswith('.npz'):
-            # Pre-encoded
-            with np.load(path) as npz:
-                for item in npz.files:
-                    token_chunks.append(npz[item])
-        else:
-            with open(path, 'r') as fp:
-                raw_text = fp.read()
-            tokens = np.stack(enc.encode(raw_text))
-            token_chunks.append(tokens)
-    return token_chunks
-
-
-def binary_search(f, lo, hi):
-    if f(lo) or not f(hi):
-        return None
-    while hi > lo + 1:
-        mid = (lo + hi) // 2
-        if f(mid):
-            hi = mid
-        else:
-            lo = mid
-    return hi
-
-
-class Sampler(object):
-    """Fairly samples a slice from a set of variable sized chunks.
-
-    'Fairly' means that the distribution is the same as sampling from one concatenated chunk,
-    but without crossing chunk boundaries."""
-
-    def __init__(self, chunks):
-        self.chunks = chunks
-        self.total_size = sum(chunk.shape[0] for chunk in chunks)
-        self.boundaries = [0]
-        for i in range(len(chunks)):
-            self.boundaries.append(self.boundaries[-1] + chunks[i].shape[0])
-
-    def sample(self, length):
-        assert length < self.total_size // len(
-            self.chunks
-        ), "Dataset files are too small to sample {} tokens at a time".format(length)
-        while True:
-            index = random.randint(0, self.total_size - length - 1)
-            i = binary_search(lambda j: self.boundaries[j] > index, 0,
-                              len(self.boundaries) - 1) - 1
-            if self.boundaries[i + 1] > index + length:
-                within_chunk = index - self.boundaries[i]
-                return self.chunks[i][within_chunk:within_chunk + length]
-
-
 def train_main(dataset,
                valset,
                model_name='774M',
@@ -110,7 +53,16 @@ def train_main(dataset,
                beta2=0.999,
                epsilon=1e-08,
                save_every=1000,
-               layers_to_train=144):
+               layers_to_train=144,
+               combine=None,
+               prefetch=4,
+               sampling='random',
+               val_batch_size=None,
+               val_batch_count=0,
+               val_every=None,
+               accumulate_gradients=1,
+               memory_saving_gradients='off',
+               train_blocks=None):
 
     enc = encoder.get_encoder(model_name)
     hparams = model.default_hparams()
@@ -123,13 +75,58 @@ def train_main(dataset,
         raise ValueError(
             "Can't get samples longer than window size: %s" % hparams.n_ctx)
 
+    print('Loading dataset...')
+    data_sampler = load_sampler(enc, dataset, combine=combine, length=batch_length, cache=True)
+    print('dataset has', data_sampler.total_size, 'tokens')
+    print('dataset has', data_sampler.windows(batch_length), 'windows of', batch_length, 'tokens to sample from')
+
+    if sampling == 'epoch':
+        if not isinstance(data_sampler, Sampler):
+            raise ValueError('Epoch sampling does not mix several datasets')
+        # Every non-overlapping window once per epoch, resuming from the saved position
+        epoch_sampler = EpochSampler(data_sampler.chunks, batch_length, seed=seed or 0)
+        epoch_sampler.restore(os.path.join(CHECKPOINT_DIR, run_name, 'epoch'))
+        epoch_position = epoch_sampler.position
+        print('epoch has', epoch_sampler.windows, 'windows, starting at window',
+              epoch_position % epoch_sampler.windows, 'of epoch', epoch_sampler.epoch)
+        make_batch = lambda: epoch_sampler.sample_batch(batch_size)
+    elif sampling == 'random':
+        epoch_sampler = None
+        # The prefetch thread draws from its own generator, so that the batches
+        # depend only on the seed and not on when sampling or validation run.
+        batch_rng = np.random.RandomState(seed)
+        make_batch = lambda: data_sampler.sample_batch(batch_size, batch_length, rng=batch_rng)
+    else:
+        raise ValueError("sampling must be 'random' or 'epoch', not %r" % (sampling,))
+
+    print('Loading valset...')
+    val_data_sampler = load_sampler(enc, valset, combine=combine, length=batch_length, cache=True)
+    print('valset has', val_data_sampler.total_size, 'tokens')
+    print('valset has', val_data_sampler.windows(batch_length), 'windows of', batch_length, 'tokens to sample from')
+
+    if val_batch_count:
+        # Score the same windows every time, in batches, for an exact mean loss
+        val_batch_size = val_batch_size or batch_size
+        val_every = val_every or save_every
+        val_windows = validation_windows(val_data_sampler, val_batch_size * val_batch_count, batch_length)
+        val_batches = [val_windows[i:i + val_batch_size] for i in range(0, len(val_windows), val_batch_size)]
+        print('Validating on', len(val_windows), 'windows every', val_every, 'steps')
+
+    frozen_layers = model.frozen_layers(hparams, train_blocks)
+
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
     with tf.Session(config=config) as sess:
-        context = tf.placeholder(tf.int32, [batch_size, None])
         np.random.seed(seed)
         tf.set_random_seed(seed)
-        output = model.model(hparams=hparams, X=context)
+        # Batches are made ahead on a background thread and read by the graph itself,
+        # so training steps feed nothing; feeding context still overrides them.
+        prefetcher = BatchPrefetcher(make_batch, prefetch)
+        batches = tf.data.Dataset.from_generator(
+            prefetcher.__iter__, tf.int32, tf.TensorShape([batch_size, batch_length]))
+        context = tf.placeholder_with_default(
+            batches.make_one_shot_iterator().get_next(), [batch_size, None])
+        output = model.model(hparams=hparams, X=context, frozen_layers=frozen_layers)
         loss = tf.reduce_mean(
             tf.nn.sparse_softmax_cross_entropy_with_logits(
                 labels=context[:, 1:], logits=output['logits'][:, :-1]))
@@ -143,15 +140,27 @@ def train_main(dataset,
             top_k=40)
 
         all_vars = [v for v in tf.trainable_variables() if 'model' in v.name]
-        #this line is to hopefully reduce memory usage (found on Twitter: https://twitter.com/BasedBlue/status/1169601983046672385?s=20)
-        train_vars = all_vars[-layers_to_train:]
-        print("Training", layers_to_train, "layers out of", len(all_vars))
+        if train_blocks is not None:
+            train_vars = model.block_variables(all_vars, frozen_layers)
+            print("Training the top", train_blocks, "blocks out of", hparams.n_layer)
+        else:
+            #this line is to hopefully reduce memory usage (found on Twitter: https://twitter.com/BasedBlue/status/1169601983046672385?s=20)
+            train_vars = all_vars[-layers_to_train:]
+            print("Training", layers_to_train, "layers out of", len(all_vars))
         opt = tf.train.AdamOptimizer(learning_rate=learning_rate,
                                      beta1=beta1,
                                      beta2=beta2,
-                                     epsilon=epsilon
-                                     ).minimize(loss,
-                                                var_list=train_vars)
+                                     epsilon=epsilon)
+        train_ops = build_train_ops(opt, loss, train_vars, memory_saving_gradients, accumulate_gradients)
+        peak_memory = PeakMemory()
+
+        if val_batch_count:
+            # Forward pass only, sharing the weights; no gradient is taken through it.
+            val_context = tf.placeholder(tf.int32, [None, None])
+            val_output = model.model(hparams=hparams, X=val_context, reuse=True)
+            val_loss_sum = tf.reduce_sum(
+                tf.nn.sparse_softmax_cross_entropy_with_logits(
+                    labels=val_context[:, 1:], logits=val_output['logits'][:, :-1]))
 
         saver = tf.train.Saver(
             var_list=all_vars,
@@ -173,17 +182,6 @@ def train_main(dataset,
             ckpt = tf.train.latest_checkpoint(restore_from)
         print('Loading checkpoint', ckpt)
         saver.restore(sess, ckpt)
-
-        print('Loading dataset...')
-        chunks = load_dataset(enc, dataset)
-        data_sampler = Sampler(chunks)
-        print('dataset has', data_sampler.total_size, 'tokens')
-        print('Training...')
-
-        print('Loading valset...')
-        val_chunks = load_dataset(enc, valset)
-        val_data_sampler = Sampler(val_chunks)
-        print('valset has', val_data_sampler.total_size, 'tokens')
         print('Training...')
 
         counter = 1
@@ -207,6 +205,16 @@ def train_main(dataset,
             with open(os.path.join(CHECKPOINT_DIR, run_name, 'counter'),
                       'w') as fp:
                 fp.write(str(counter) + '\n')
+            if epoch_sampler is not None:
+                epoch_sampler.save(
+                    os.path.join(CHECKPOINT_DIR, run_name, 'epoch'),
+                    epoch_position)
+
+        def validate():
+            total = 0.0
+            for val_batch in val_batches:
+                total += sess.run(val_loss_sum, feed_dict={val_context: val_batch})
+            return total / (len(val_windows) * (batch_length - 1))
 
         def generate_samples():
             context_tokens = data_sampler.sample(1)
@@ -241,33 +249,60 @@ def train_main(dataset,
                 if counter % sample_every == 0:
                     generate_samples()
 
-                batch = [data_sampler.sample(batch_length) for _ in range(batch_size)]
-
-                _, lv = sess.run((opt, loss), feed_dict={context: batch})
+                step_start = time.time()
+                lv = run_train_step(sess, train_ops, accumulate_gradients)
+                step_time = time.time() - step_start
+                wait = prefetcher.pop_wait_time()
+                if epoch_sampler is not None:
+                    epoch = epoch_position // epoch_sampler.windows
+                    epoch_position += batch_size * accumulate_gradients
+                    if epoch_position // epoch_sampler.windows != epoch:
+                        print('Starting epoch', epoch_position // epoch_sampler.windows)
 
                 avg_loss = (avg_loss[0] * 0.99 + lv, avg_loss[1] * 0.99 + 1.0)
 
                 print(
-                    '[{counter} | {time:2.2f}] loss={loss:2.4f} avg={avg:2.4f}'
+                    '[{counter} | {time:2.2f}] loss={loss:2.4f} avg={avg:2.4f} wait={wait:2.4f} step={step:2.2f}s peak={peak:2.0f}MB'
                     .format(
                         counter=counter,
                         time=time.time() - start_time,
                         loss=lv,
-                        avg=avg_loss[0] / avg_loss[1]))
-
-                if counter % 5 == 0:
-                    valbatch = [val_data_sampler.sample(batch_length) for _ in range(batch_size)]
-                    valacc = sess.run(loss, feed_dict={context: valbatch})
-                    val_loss = (val_loss[0] * 0.99 + valacc, val_loss[1] * 0.99 + 1.0)
-                    av_val_loss = val_loss[0] / val_loss[1]
-                    print(
-                        '[{counter} | {time:2.2f}] VAL_loss={loss:2.4f} VAL_avg={avg:2.4f} best={best:2.4f}'
-                        .format(
-                            counter=counter,
-                            time=time.time() - start_time,
-                            loss=valacc,
-                            avg=av_val_loss,
-                            best=best_val_loss))
+                        avg=avg_loss[0] / avg_loss[1],
+                        step=step_time,
+                        peak=peak_memory(sess) / 2**20,
+                        wait=wait))
+
+                if val_batch_count:
+                    # Fresh validation before every checkpoint decision as well
+                    validating = counter % val_every == 0 or counter % save_every == 0
+                else:
+                    validating = counter % 5 == 0
+                if validating:
+                    if val_batch_count:
+                        val_start = time.time()
+                        av_val_loss = validate()
+                        print(
+                            '[{counter} | {time:2.2f}] VAL_loss={loss:2.4f} VAL_ppl={ppl:2.2f} best={best:2.4f} ({val_time:2.2f}s)'
+                            .format(
+                                counter=counter,
+                                time=time.time() - start_time,
+                                loss=av_val_loss,
+                                ppl=np.exp(av_val_loss),
+                                best=best_val_loss,
+                                val_time=time.time() - val_start))
+                    else:
+                        valbatch = val_data_sampler.sample_batch(batch_size, batch_length)
+                        valacc = sess.run(loss, feed_dict={context: valbatch})
+                        val_loss = (val_loss[0] * 0.99 + valacc, val_loss[1] * 0.99 + 1.0)
+                        av_val_loss = val_loss[0] / val_loss[1]
+                        print(
+                            '[{counter} | {time:2.2f}] VAL_loss={loss:2.4f} VAL_avg={avg:2.4f} best={best:2.4f}'
+                            .format(
+                                counter=counter,
+                                time=time.time() - start_time,
+                                loss=valacc,
+                                avg=av_val_loss,
+                                best=best_val_loss))
                     if counter >= save_every and counter % save_every == 0: # check for validation checkpoints every save_every iterations.
                         if av_val_loss < best_val_loss: # got a good one from validation, save a checkpoint (every save_every)
                             save()
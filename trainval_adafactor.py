@@ -1,21 +1,28 @@
 #!/usr/bin/env python3
 # Usage:
 #  PYTHONPATH=src ./train --dataset <file|directory|glob>
+# Several datasets are mixed by weight, rather than by size, with:
+#  PYTHONPATH=src ./train --dataset <dataset>:0.7,<dataset>:0.3
+# Datasets of short documents can be packed, joined by <|endoftext|>, with:
+#  PYTHONPATH=src ./train --dataset <file|directory|glob> --combine 1024
+# Only the top N blocks and the final layer norm are trained, with the embeddings
+# (wte, wpe) left as they are unless N is the model's number of layers, with:
+#  PYTHONPATH=src ./train --dataset <file|directory|glob> --train_blocks N
 
 import fire
 import json
 import os
-import glob
 import numpy as np
 import tensorflow as tf
-import random
 import time
 from tensorflow.core.protobuf import rewriter_config_pb2
 
 import model
 import sample
 import encoder
-import memory_saving_gradients
+from load_dataset import load_sampler
+from accumulate import build_train_ops, run_train_step
+from peak_memory import PeakMemory
 
 CHECKPOINT_DIR = 'checkpoint'
 SAMPLE_DIR = 'samples'
@@ -28,73 +35,6 @@ def maketree(path):
         pass
 
 
-def load_dataset(enc, path):
-    paths = []
-    if os.path.isfile(path):
-        # Simple file
-        paths.append(path)
-    elif os.path.isdir(path):
-        # Directory
-        for (dirpath, _, fnames) in os.walk(path):
-            for fname in fnames:
-                paths.append(os.path.join(dirpath, fname))
-    else:
-        paths = glob.glob(path)
-
-    token_chunks = []
-    for path in paths:
-        print('Reading', path)
-        if path.endswith('.npz'):
-            # Pre-encoded
-            with np.load(path) as npz:
-                for item in npz.files:
-                    token_chunks.append(npz[item])
-        else:
-            with open(path, 'r') as fp:
-                raw_text = fp.read()
-            tokens = np.stack(enc.encode(raw_text))
-            token_chunks.append(tokens)
-    return token_chunks
-
-
-def binary_search(f, lo, hi):
-    if f(lo) or not f(hi):
-        return None
-    while hi > lo + 1:
-        mid = (lo + hi) // 2
-        if f(mid):
-            hi = mid
-        else:
-            lo = mid
-    return hi
-
-
-class Sampler(object):
-    """Fairly samples a slice from a set of variable sized chunks.
-
-    'Fairly' means that the distribution is the same as sampling from one concatenated chunk,
-    but without crossing chunk boundaries."""
-
-    def __init__(self, chunks):
-        self.chunks = chunks
-        self.total_size = sum(chunk.shape[0] for chunk in chunks)
-        self.boundaries = [0]
-        for i in range(len(chunks)):
-            self.boundaries.append(self.boundaries[-1] + chunks[i].shape[0])
-
-    def sample(self, length):
-        assert length < self.total_size // len(
-            self.chunks
-        ), "Dataset files are too small to sample {} tokens at a time".format(length)
-        while True:
-            index = random.randint(0, self.total_size - length - 1)
-            i = binary_search(lambda j: self.boundaries[j] > index, 0,
-                              len(self.boundaries) - 1) - 1
-            if self.boundaries[i + 1] > index + length:
-                within_chunk = index - self.boundaries[i]
-                return self.chunks[i][within_chunk:within_chunk + length]
-
-
 def train_main(dataset,
                valset,
                model_name='774M',
@@ -112,7 +52,11 @@ def train_main(dataset,
                beta2=0.999,
                epsilon=1e-08,
                save_every=1000,
-               layers_to_train=144):
+               layers_to_train=144,
+               combine=None,
+               accumulate_gradients=1,
+               memory_saving_gradients='collection',
+               train_blocks=None):
 
     enc = encoder.get_encoder(model_name)
     hparams = model.default_hparams()
@@ -125,6 +69,8 @@ def train_main(dataset,
         raise ValueError(
             "Can't get samples longer than window size: %s" % hparams.n_ctx)
 
+    frozen_layers = model.frozen_layers(hparams, train_blocks)
+
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
     config.graph_options.rewrite_options.layout_optimizer = rewriter_config_pb2.RewriterConfig.OFF
@@ -132,7 +78,7 @@ def train_main(dataset,
         context = tf.placeholder(tf.int32, [batch_size, None])
         np.random.seed(seed)
         tf.set_random_seed(seed)
-        output = model.model(hparams=hparams, X=context)
+        output = model.model(hparams=hparams, X=context, frozen_layers=frozen_layers)
         loss = tf.reduce_mean(
             tf.nn.sparse_softmax_cross_entropy_with_logits(
                 labels=context[:, 1:], logits=output['logits'][:, :-1]))
@@ -146,9 +92,13 @@ def train_main(dataset,
             top_k=40)
 
         all_vars = [v for v in tf.trainable_variables() if 'model' in v.name]
-        #this line is to hopefully reduce memory usage (found on Twitter: https://twitter.com/BasedBlue/status/1169601983046672385?s=20)
-        train_vars = all_vars[-layers_to_train:]
-        print("Training", layers_to_train, "layers out of", len(all_vars))
+        if train_blocks is not None:
+            train_vars = model.block_variables(all_vars, frozen_layers)
+            print("Training the top", train_blocks, "blocks out of", hparams.n_layer)
+        else:
+            #this line is to hopefully reduce memory usage (found on Twitter: https://twitter.com/BasedBlue/status/1169601983046672385?s=20)
+            train_vars = all_vars[-layers_to_train:]
+            print("Training", layers_to_train, "layers out of", len(all_vars))
         
         decay_rate = adafactor_decay_rate_adam(beta2)
         opt = AdafactorOptimizer(
@@ -156,9 +106,8 @@ def train_main(dataset,
             decay_rate=decay_rate,
             beta1=beta1,
             name="Adafactor")
-        opt_grads = memory_saving_gradients.gradients(loss, train_vars)
-        opt_grads = list(zip(opt_grads, train_vars))
-        opt_apply = opt.apply_gradients(opt_grads)
+        train_ops = build_train_ops(opt, loss, train_vars, memory_saving_gradients, accumulate_gradients)
+        peak_memory = PeakMemory()
         summary_loss = tf.summary.scalar('loss', loss)
 
         saver = tf.train.Saver(
@@ -183,15 +132,15 @@ def train_main(dataset,
         saver.restore(sess, ckpt)
 
         print('Loading dataset...')
-        chunks = load_dataset(enc, dataset)
-        data_sampler = Sampler(chunks)
+        data_sampler = load_sampler(enc, dataset, combine=combine, length=batch_length, cache=True)
         print('dataset has', data_sampler.total_size, 'tokens')
+        print('dataset has', data_sampler.windows(batch_length), 'windows of', batch_length, 'tokens to sample from')
         print('Training...')
 
         print('Loading valset...')
-        val_chunks = load_dataset(enc, valset)
-        val_data_sampler = Sampler(val_chunks)
+        val_data_sampler = load_sampler(enc, valset, combine=combine, length=batch_length, cache=True)
         print('valset has', val_data_sampler.total_size, 'tokens')
+        print('valset has', val_data_sampler.windows(batch_length), 'windows of', batch_length, 'tokens to sample from')
         print('Training...')
 
         counter = 1
@@ -249,22 +198,25 @@ def train_main(dataset,
                 if counter % sample_every == 0:
                     generate_samples()
 
-                batch = [data_sampler.sample(batch_length) for _ in range(batch_size)]
-
-                _, lv = sess.run((opt_apply, loss), feed_dict={context: batch})
+                step_start = time.time()
+                lv = run_train_step(sess, train_ops, accumulate_gradients,
+                                    feed=lambda: {context: data_sampler.sample_batch(batch_size, batch_length)})
+                step_time = time.time() - step_start
 
                 avg_loss = (avg_loss[0] * 0.99 + lv, avg_loss[1] * 0.99 + 1.0)
 
                 print(
-                    '[{counter} | {time:2.2f}] loss={loss:2.4f} avg={avg:2.4f}'
+                    '[{counter} | {time:2.2f}] loss={loss:2.4f} avg={avg:2.4f} step={step:2.2f}s peak={peak:2.0f}MB'
                     .format(
                         counter=counter,
                         time=time.time() - start_time,
                         loss=lv,
-                        avg=avg_loss[0] / avg_loss[1]))
+                        avg=avg_loss[0] / avg_loss[1],
+                        step=step_time,
+                        peak=peak_memory(sess) / 2**20))
 
                 if counter % 5 == 0:
-                    valbatch = [val_data_sampler.sample(batch_length) for _ in range(batch_size)]
+                    valbatch = val_data_sampler.sample_batch(batch_size, batch_length)
                     valacc = sess.run(loss, feed_dict={context: valbatch})
                     val_loss = (val_loss[0] * 0.99 + valacc, val_loss[1] * 0.99 + 1.0)
                     av_val_loss = val_loss[0] / val_loss[1]